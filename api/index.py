@@ -1,13 +1,56 @@
 import os
 import base64
+import contextvars
+import importlib
+import importlib.util
+import itertools
 import json
+import logging
+import math
+import random
 import re
-from urllib.parse import urlencode
-from dotenv import load_dotenv
-import requests
-from flask import Flask, request, redirect, url_for, session, render_template
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import urlencode, urlparse
+from flask import Flask, request, redirect, url_for, session, render_template, jsonify, make_response, g
+from jinja2 import FileSystemBytecodeCache
+
+class Lazy:
+    """
+    Stands in for a module (or object) that is only imported / built on first attribute access.
+    Cold starts that just serve the form or the loading page never pay for requests, asyncio etc.
+    """
+
+    def __init__(self, load):
+        self._load = load
+        self._target = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if self._target is None:
+            with self._lock:
+                if self._target is None:
+                    self._target = self._load()
+        return getattr(self._target, name)
+
+def lazy_import(name):
+    return Lazy(lambda: importlib.import_module(name))
+
+# only needed once a request talks to Spotify / a sqlite backend / the CLI
+requests = lazy_import("requests")
+asyncio = lazy_import("asyncio")
+sqlite3 = lazy_import("sqlite3")
+argparse = lazy_import("argparse")
+cProfile = lazy_import("cProfile")
 
 if os.getenv("VERCEL") is None:
+    from dotenv import load_dotenv
     load_dotenv()
 
 # Initialize Flask app
@@ -17,17 +60,478 @@ app = Flask(
     template_folder=os.path.join(os.path.dirname(__file__), "..", "templates")
 )
 
+class TemplateBytecodeCache(FileSystemBytecodeCache):
+    """Jinja's bytecode cache, but a read-only directory (the deployed bundle) is fine: nothing is written."""
+
+    def dump_bytecode(self, bucket):
+        try:
+            super().dump_bytecode(bucket)
+        except OSError:
+            pass
+
+# Compiled templates are cached on disk, so a restart doesn't parse + compile them again. Fill the
+# directory with `python api/index.py precompile-templates`; "" turns the cache off. Off by default on
+# Vercel: the build doesn't precompile them and the deployed bundle is read-only, so it would never fill
+TEMPLATE_CACHE_DIR = os.getenv("TEMPLATE_CACHE_DIR", "" if os.getenv("VERCEL") else os.path.join(os.path.dirname(__file__), "..", "templates", ".jinja-cache"))
+if TEMPLATE_CACHE_DIR:
+    app.jinja_env.bytecode_cache = TemplateBytecodeCache(TEMPLATE_CACHE_DIR)
+
 app.secret_key = os.getenv("SECRET_KEY", "your-secret-key-change-in-production")  # Required for sessions
 
 # Spotify credentials from .env file
 client_id = os.getenv("CLIENT_ID")
 client_secret = os.getenv("CLIENT_SECRET") #make this dynamic
 redirect_uri = os.getenv("REDIRECT_URI")
+# Where the Spotify APIs live - pointed at bench/fake_spotify.py for offline benchmarks
+SPOTIFY_API_BASE = os.getenv("SPOTIFY_API_BASE", "https://api.spotify.com/v1").rstrip("/")
+SPOTIFY_ACCOUNTS_BASE = os.getenv("SPOTIFY_ACCOUNTS_BASE", "https://accounts.spotify.com").rstrip("/")
+
+# Max number of requests about the user's library (liked songs pages, saved checks) in flight at once
+LIKED_SONGS_WORKERS = int(os.getenv("LIKED_SONGS_WORKERS", "8"))
+# How songs the user knows are found:
+#   "library" - download the whole liked songs library (or the delta since their snapshot)
+#   "stream"  - match liked songs against the artist/setlist candidates page by page, stopping once all are found
+#   "contains" - ask spotify directly whether each candidate is saved (/me/tracks/contains), never reading the library
+KNOWN_SONGS_STRATEGY = os.getenv("KNOWN_SONGS_STRATEGY", "library")
+# Max number of setlist requests (candidate playlists, pages of the chosen one) in flight at once
+SETLIST_DETAIL_WORKERS = int(os.getenv("SETLIST_DETAIL_WORKERS", "8"))
+
+############################## INSTRUMENTATION ##############################
+
+# Every Spotify call is counted per endpoint (calls, bytes, retries, 429s, errors, time) and per pipeline
+# stage, and each /process run / job / batch logs one JSON line with those counts plus the stage timings.
+# SERVER_TIMING=1 adds a Server-Timing header to results; PROFILE_REQUESTS=1 lets ?profile=1 dump a cProfile
+# of that request to PROFILE_DIR (request thread only - worker threads aren't included)
+SERVER_TIMING = os.getenv("SERVER_TIMING", "0") == "1"
+PROFILE_REQUESTS = os.getenv("PROFILE_REQUESTS", "0") == "1"
+PROFILE_DIR = os.getenv("PROFILE_DIR", tempfile.gettempdir())
+
+logger = logging.getLogger("soundcheck")
+if not logger.handlers:
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+current_metrics = contextvars.ContextVar("current_metrics", default=None)
+current_stage = contextvars.ContextVar("current_stage", default=None)
+
+class ContextThreadPoolExecutor(ThreadPoolExecutor):
+    """ThreadPoolExecutor whose tasks run in a copy of the submitting thread's context, so metrics follow the work."""
+
+    def submit(self, fn, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+def endpoint_name(method, url):
+    # ids are folded out so calls group by endpoint: GET /v1/playlists/{id}/tracks
+    path = re.sub(r'/(artists|playlists|albums|users)/[^/]+', r'/\1/{id}', urlparse(url).path)
+    return f"{method} {path}"
+
+class RequestMetrics:
+    """Spotify call counters + stage timers for one unit of work (a request, a job, a batch)."""
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.perf_counter()
+        self.endpoints = {}
+        self.stage_calls = {}
+        self.timers = []
+        self.lock = threading.Lock()
+
+    def record(self, method, url, response, retries, rate_limited, elapsed):
+        stage = current_stage.get()
+        with self.lock:
+            stats = self.endpoints.setdefault(endpoint_name(method, url), {
+                "calls": 0, "bytes": 0, "retries": 0, "rate_limited": 0, "errors": 0, "ms": 0.0})
+            stats["calls"] += 1
+            stats["retries"] += retries
+            stats["rate_limited"] += rate_limited
+            stats["ms"] = round(stats["ms"] + elapsed * 1000, 1)
+            if response is None or response.status_code >= 400:
+                stats["errors"] += 1
+            if response is not None:
+                stats["bytes"] += len(response.content or b"")
+            if stage:
+                self.stage_calls[stage] = self.stage_calls.get(stage, 0) + 1
+
+    def stages(self):
+        stages = {}
+        for timer in self.timers:
+            for name, timing in timer.stages.items():
+                stages[name] = dict(timing, spotify_calls=self.stage_calls.get(name, 0))
+        return stages
+
+    def total_ms(self):
+        return round((time.perf_counter() - self.start) * 1000, 1)
+
+    def summary(self):
+        return {
+            "event": self.name,
+            "total_ms": self.total_ms(),
+            "stages": self.stages(),
+            "spotify_calls": sum(e["calls"] for e in self.endpoints.values()),
+            "spotify": self.endpoints,
+        }
+
+    def server_timing(self):
+        parts = []
+        for name, timing in self.stages().items():
+            token = re.sub(r'[^A-Za-z0-9_-]+', '_', name).strip('_')
+            parts.append(f'{token};dur={timing["duration_ms"]};desc="{timing["spotify_calls"]} calls"')
+        parts.append(f"total;dur={self.total_ms()}")
+        return ", ".join(parts)
+
+@contextmanager
+def instrumented(name, **fields):
+    """Collects RequestMetrics for the work in the block (and any worker threads it starts) and logs them as JSON."""
+    metrics = RequestMetrics(name)
+    token = current_metrics.set(metrics)
+    try:
+        yield metrics
+    finally:
+        current_metrics.reset(token)
+        logger.info(json.dumps(dict(metrics.summary(), **fields)))
+
+############################## SPOTIFY HTTP CLIENT ##############################
+
+# Seconds to wait for Spotify to connect / respond
+SPOTIFY_TIMEOUT = float(os.getenv("SPOTIFY_TIMEOUT", "10"))
+# How many times a failed call is retried (429, 5xx, dropped connections)
+SPOTIFY_MAX_RETRIES = int(os.getenv("SPOTIFY_MAX_RETRIES", "4"))
+# Exponential backoff: base * 2^attempt seconds, capped, with full jitter
+SPOTIFY_BACKOFF_BASE = float(os.getenv("SPOTIFY_BACKOFF_BASE", "0.5"))
+SPOTIFY_BACKOFF_MAX = float(os.getenv("SPOTIFY_BACKOFF_MAX", "8"))
+# Longest Retry-After we'll sleep through. Spotify's rate limit penalties can last minutes or hours, so a
+# 429 asking for more than this is returned straight away instead of holding the request open
+SPOTIFY_MAX_RETRY_AFTER = float(os.getenv("SPOTIFY_MAX_RETRY_AFTER", "10"))
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+IDEMPOTENT_METHODS = {"GET", "PUT", "DELETE"}
+
+def make_spotify_session():
+    #one keep-alive connection pool shared by every call, instead of a new TLS handshake per request
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+spotify_session = Lazy(make_spotify_session)  # built by the first Spotify call
+
+def retry_delay(response, attempt):
+    """Seconds to wait before retrying, or None if spotify wants us to wait longer than SPOTIFY_MAX_RETRY_AFTER."""
+    #spotify answers 429 with a Retry-After header (seconds) telling us exactly how long to wait
+    if response is not None and response.status_code == 429:
+        retry_after = response.headers.get("Retry-After", "")
+        try:
+            delay = max(0.0, float(retry_after))
+        except ValueError:
+            delay = None
+        if delay is not None:
+            return delay if delay <= SPOTIFY_MAX_RETRY_AFTER else None
+    return random.uniform(0, min(SPOTIFY_BACKOFF_MAX, SPOTIFY_BACKOFF_BASE * 2 ** attempt))
+
+def spotify_request(method, url, max_retries=None, **kwargs):
+    """
+    requests.request() through the shared session, retrying rate limits, 5xx and dropped connections.
+    POSTs are only retried on 429 (spotify didn't process them), so we never create a playlist twice.
+    Returns the last response, like requests would.
+    """
+    max_retries = SPOTIFY_MAX_RETRIES if max_retries is None else max_retries
+    kwargs.setdefault("timeout", SPOTIFY_TIMEOUT)
+    retry_statuses = RETRY_STATUSES if method in IDEMPOTENT_METHODS else {429}
+    metrics = current_metrics.get()
+    started = time.perf_counter()
+    rate_limited = 0
+
+    for attempt in range(max_retries + 1):
+        try:
+            response = spotify_session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt == max_retries or method not in IDEMPOTENT_METHODS:
+                if metrics:
+                    metrics.record(method, url, None, attempt, rate_limited, time.perf_counter() - started)
+                raise
+            print(f"{method} {url} failed ({e}), retrying")
+            time.sleep(retry_delay(None, attempt))
+            continue
+
+        if response.status_code == 429:
+            rate_limited += 1
+        delay = retry_delay(response, attempt) if response.status_code in retry_statuses else None
+        if delay is None or attempt == max_retries:
+            if metrics:
+                metrics.record(method, url, response, attempt, rate_limited, time.perf_counter() - started)
+            return response
+        print(f"{method} {url} returned {response.status_code}, retrying in {delay:.1f}s")
+        time.sleep(delay)
+
+def spotify_get(url, **kwargs):
+    return spotify_request("GET", url, **kwargs)
+
+def spotify_post(url, **kwargs):
+    return spotify_request("POST", url, **kwargs)
+
+############################## SHARED CACHE ##############################
+
+# Artist lookups, artist top tracks and setlists are the same for every user going to the same show,
+# so they are cached across users. "memory" = per-process LRU, "sqlite" = file shared by every worker on one box
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")
+CACHE_PATH = os.getenv("CACHE_PATH", os.path.join(tempfile.gettempdir(), "soundcheck-cache.sqlite3"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "2048"))
+# Seconds an entry is fresh, then how much longer it is still served (while refreshing in the background)
+CACHE_TTL = int(os.getenv("CACHE_TTL", str(6 * 60 * 60)))
+CACHE_STALE_TTL = int(os.getenv("CACHE_STALE_TTL", str(24 * 60 * 60)))
+
+class MemoryCache:
+    """In-process LRU of key -> (value, stored_at)."""
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, value, stored_at):
+        with self.lock:
+            self.entries[key] = (value, stored_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+class SQLiteCache:
+    """Same interface as MemoryCache, stored as JSON in a SQLite file so every process on the box shares it."""
+
+    def __init__(self, path=CACHE_PATH, max_entries=CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, stored_at REAL, used_at REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS cache_used_at ON cache (used_at)")
+
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT value, stored_at FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.db.execute("UPDATE cache SET used_at = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0], object_hook=decode_cached), row[1]
+
+    def set(self, key, value, stored_at):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)", (key, json.dumps(value, default=encode_cached), stored_at, time.time()))
+            # least recently used entries go first
+            self.db.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def delete(self, key):
+        with self.lock:
+            self.db.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+def encode_cached(value):
+    if isinstance(value, Track):
+        return {"__track__": value.to_json()}
+    raise TypeError(f"Can't cache {type(value).__name__}")
+
+def decode_cached(data):
+    if "__track__" in data:
+        return Track.from_json(data["__track__"])
+    return data
+
+def make_cache_backend():
+    if CACHE_BACKEND == "sqlite":
+        return SQLiteCache()
+    return MemoryCache()
+
+class ResultCache:
+    """
+    TTL + stale-while-revalidate on top of a backend: fresh entries are returned as is, stale ones are
+    returned immediately while a background thread refreshes them, expired ones are recomputed.
+    """
+
+    def __init__(self, backend, ttl=CACHE_TTL, stale_ttl=CACHE_STALE_TTL):
+        self.backend = backend
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.stats = {}
+        self.refreshing = set()
+        self.lock = threading.Lock()
+
+    def count(self, namespace, outcome):
+        with self.lock:
+            counters = self.stats.setdefault(namespace, {"hits": 0, "stale_hits": 0, "misses": 0, "refreshes": 0})
+            counters[outcome] += 1
+
+    def store(self, key, value):
+        # errors / empty results aren't cached, so the next request tries again
+        if value is not None and (not isinstance(value, (tuple, list)) or value and value[0] is not None):
+            self.backend.set(key, value, time.time())
+        return value
+
+    def refresh(self, namespace, key, compute):
+        with self.lock:
+            if key in self.refreshing:  # someone is already refreshing it
+                return
+            self.refreshing.add(key)
+
+        def run():
+            try:
+                self.store(key, compute())
+                self.count(namespace, "refreshes")
+            except Exception as e:
+                print(f"Cache refresh failed for {key}: {e}")
+            finally:
+                with self.lock:
+                    self.refreshing.discard(key)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def lookup(self, namespace, key, compute):
+        """(True, value) for a fresh or stale entry - stale ones are refreshed with compute - else (False, None)."""
+        entry = self.backend.get(key)
+        if entry is not None:
+            value, stored_at = entry
+            age = time.time() - stored_at
+            if age < self.ttl:
+                self.count(namespace, "hits")
+                return True, value
+            if age < self.ttl + self.stale_ttl:
+                self.count(namespace, "stale_hits")
+                self.refresh(namespace, key, compute)
+                return True, value
+            self.backend.delete(key)
+
+        self.count(namespace, "misses")
+        return False, None
+
+    def get_or_compute(self, namespace, key, compute):
+        found, value = self.lookup(namespace, key, compute)
+        if found:
+            return value
+        return self.store(key, compute())
+
+shared_cache = ResultCache(make_cache_backend())
+
+def normalize_key_part(part):
+    return " ".join(str(part or "").lower().split())
+
+def cached_across_users(namespace, key_args):
+    """
+    Caches fn's result in shared_cache under namespace + the normalized values of key_args
+    (the access token is never part of the key). The uncached function stays available as fn.uncached.
+    """
+    def decorator(fn):
+        def wrapper(*args, **kwargs):
+            bound = dict(zip(fn.__code__.co_varnames, args), **kwargs)
+            key = "|".join([namespace] + [normalize_key_part(bound.get(arg)) for arg in key_args])
+            return shared_cache.get_or_compute(namespace, key, lambda: fn(*args, **kwargs))
+        wrapper.__name__ = fn.__name__
+        wrapper.__doc__ = fn.__doc__
+        wrapper.uncached = fn
+        return wrapper
+    return decorator
+
+############################## TRACKS ##############################
+
+# "Song - Remastered 2011", "Song (Live)", "Song (feat. Someone)" -> "song". Only bracketed / dashed
+# suffixes that mention a version word are stripped, so "Live Forever" stays as is
+VERSION_WORDS = r"remaster\w*|live|feat|ft|featuring|with|edit|version|mono|stereo|deluxe|bonus|anniversary|re-?recorded"
+VERSION_BRACKETS = re.compile(rf"\s*[(\[][^)\]]*\b(?:{VERSION_WORDS})\b[^)\]]*[)\]]", re.IGNORECASE)
+VERSION_DASH = re.compile(rf"\s+-\s+[^-]*\b(?:{VERSION_WORDS})\b.*$", re.IGNORECASE)
+FEATURING = re.compile(r"\s+(?:feat\.?|ft\.|featuring)\s.*$", re.IGNORECASE)
+
+def normalize_title(name):
+    """Lowercase song title without version suffixes or punctuation, for matching different releases of a song."""
+    title = VERSION_DASH.sub("", VERSION_BRACKETS.sub("", name or ""))
+    title = FEATURING.sub("", title)
+    return " ".join(re.findall(r"\w+", title.lower())) or (name or "").lower().strip()
+
+class Track:
+    """
+    The few fields of a Spotify track object we actually use. Fetchers project every track into one of
+    these as soon as a page is parsed, so the full JSON (album art, markets, ...) is never kept around.
+    name and artist_names are normalized (lowercase, stripped) for matching; title is the name without
+    version suffixes (see normalize_title).
+    """
+
+    __slots__ = ("uri", "name", "artist_ids", "artist_names", "isrc", "duration_ms", "title")
+
+    def __init__(self, uri, name, artist_ids=(), artist_names=(), isrc=None, duration_ms=None):
+        self.uri = uri
+        self.name = name
+        self.artist_ids = tuple(artist_ids)
+        self.artist_names = tuple(artist_names)
+        self.isrc = isrc
+        self.duration_ms = duration_ms
+        self.title = normalize_title(name)
+
+    @classmethod
+    def from_spotify(cls, track):
+        artists = [a for a in track.get('artists') or [] if a and a.get('name')]
+        return cls(
+            track.get('uri'),
+            (track.get('name') or '').lower().strip(),
+            [a.get('id') for a in artists],
+            [a['name'].lower().strip() for a in artists],
+            (track.get('external_ids') or {}).get('isrc'),
+            track.get('duration_ms'),
+        )
+
+    @property
+    def key(self):
+        #same song across album releases = same name + same set of artists
+        return self.name, frozenset(self.artist_names)
+
+    @property
+    def primary_artist(self):
+        return self.artist_names[0] if self.artist_names else None
+
+    def to_json(self):
+        return [self.uri, self.name, list(self.artist_ids), list(self.artist_names), self.isrc, self.duration_ms]
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(*data)
+
+    def __eq__(self, other):
+        return isinstance(other, Track) and self.to_json() == other.to_json()
+
+    def __hash__(self):
+        return hash((self.uri, self.name))
+
+    def __repr__(self):
+        return f"Track({self.uri!r}, {self.name!r}, artists={list(self.artist_names)!r})"
+
+def as_track(track):
+    # accepts raw spotify JSON too
+    if isinstance(track, Track):
+        return track
+    if isinstance(track, dict) and track:
+        return Track.from_spotify(track)
+    return None
+
+def parse_tracks(tracks):
+    return [Track.from_spotify(t) for t in tracks or [] if t]
 
 ############################## RETRIEVE USER'S TOP TRACKS FROM PAST 6 MONTHS ##############################
 
 def get_authorization_url():
-    auth_url = "https://accounts.spotify.com/authorize"
+    auth_url = f"{SPOTIFY_ACCOUNTS_BASE}/authorize"
     scope = "user-library-read user-read-private user-top-read user-read-recently-played playlist-modify-private playlist-modify-public"  # Updated scope
     auth_params = {
         "response_type": "code",
@@ -37,8 +541,8 @@ def get_authorization_url():
     }
     return f"{auth_url}?{urlencode(auth_params)}"
 
-def get_token(authorization_code):
-    url = "https://accounts.spotify.com/api/token"
+def request_token(data):
+    url = f"{SPOTIFY_ACCOUNTS_BASE}/api/token"
     client_creds = f"{client_id}:{client_secret}"
     client_creds_b64 = base64.b64encode(client_creds.encode()).decode()
     
@@ -46,23 +550,114 @@ def get_token(authorization_code):
         "Authorization": f"Basic {client_creds_b64}",
         "Content-Type": "application/x-www-form-urlencoded",
     }
-    data = {
-        "grant_type": "authorization_code",
-        "code": authorization_code,
-        "redirect_uri": redirect_uri,
-    }
-    response = requests.post(url, headers=headers, data=data)
+    response = spotify_post(url, headers=headers, data=data)
     
     if response.status_code == 200:
-        return response.json().get("access_token")
+        token = response.json()
+        # keep the absolute expiry so we know when to refresh
+        token["expires_at"] = time.time() + token.get("expires_in", 3600)
+        return token
     print(f"Error exchanging token: {response.status_code}, {response.text}")
     return None
 
+def exchange_token(authorization_code):
+    """Full token info for an authorization code: access_token, refresh_token, expires_at..."""
+    return request_token({
+        "grant_type": "authorization_code",
+        "code": authorization_code,
+        "redirect_uri": redirect_uri,
+    })
+
+def refresh_token(token):
+    """New token info from token's refresh_token (Spotify may or may not hand out a new refresh token)."""
+    refreshed = request_token({
+        "grant_type": "refresh_token",
+        "refresh_token": token["refresh_token"],
+    })
+    if refreshed:
+        refreshed.setdefault("refresh_token", token["refresh_token"])
+    return refreshed
+
+def get_token(authorization_code):
+    token = exchange_token(authorization_code)
+    return token.get("access_token") if token else None
+
+############################## TOKEN STORE ##############################
+
+# Tokens (including the refresh token) are kept server-side; the session cookie only holds a random key.
+# Returning users skip the OAuth redirect, and access tokens are refreshed shortly before they expire
+TOKEN_BACKEND = os.getenv("TOKEN_BACKEND", "memory")
+TOKEN_DB_PATH = os.getenv("TOKEN_DB_PATH", os.path.join(tempfile.gettempdir(), "soundcheck-tokens.sqlite3"))
+TOKEN_REFRESH_MARGIN = int(os.getenv("TOKEN_REFRESH_MARGIN", "300"))
+
+def make_token_store():
+    if TOKEN_BACKEND == "sqlite":
+        return SQLiteCache(TOKEN_DB_PATH)
+    return MemoryCache()
+
+token_store = make_token_store()
+# A refresh is a network call, so users don't wait on one lock: each token key maps to one of these
+# (a user's requests still refresh one at a time, since Spotify may hand out a new refresh token)
+TOKEN_LOCK_STRIPES = 64
+token_locks = [threading.Lock() for _ in range(TOKEN_LOCK_STRIPES)]
+
+def token_lock(token_key):
+    return token_locks[hash(token_key) % TOKEN_LOCK_STRIPES]
+
+def remember_token(token):
+    token_key = session.get('token_key') or uuid.uuid4().hex
+    token_store.set(token_key, token, time.time())
+    session['token_key'] = token_key
+    session.permanent = True  # keep the key across browser restarts
+
+def forget_token():
+    token_key = session.pop('token_key', None)
+    if token_key:
+        token_store.delete(token_key)
+
+def stored_access_token():
+    """The session's access token, refreshed first if it is about to expire; None if there isn't a usable one."""
+    token_key = session.get('token_key')
+    if not token_key:
+        return None
+    with token_lock(token_key):
+        entry = token_store.get(token_key)
+        if not entry:
+            return None
+        token = entry[0]
+        if token.get("expires_at", 0) - time.time() < TOKEN_REFRESH_MARGIN:
+            if not token.get("refresh_token"):
+                forget_token()
+                return None
+            token = refresh_token(token)
+            if not token:
+                # revoked or expired refresh token: back to the OAuth flow
+                forget_token()
+                return None
+            token_store.set(token_key, token, time.time())
+    return token["access_token"]
+
+def authorization_code_arg():
+    """?code= from the OAuth redirect; None when it's missing, empty or a placeholder like "None"."""
+    code = (request.args.get('code') or request.form.get('code') or '').strip()
+    if code.lower() in ('', 'none', 'null', 'undefined'):
+        return None
+    return code
+
+def request_access_token(authorization_code=None):
+    """Access token for this request: from the authorization code if there is one, otherwise the stored one."""
+    if authorization_code:
+        token = exchange_token(authorization_code)
+        if not token:
+            return None
+        remember_token(token)
+        return token["access_token"]
+    return stored_access_token()
 
 def user_profile(access_token):
-    url = "https://api.spotify.com/v1/me"
+    url = f"{SPOTIFY_API_BASE}/me"
     headers = {"Authorization": f"Bearer {access_token}"}
-    response = requests.get(url, headers=headers)
+    response = spotify_get(url, headers=headers)
     
     if response.status_code == 200:
         return response.json()
@@ -70,24 +665,125 @@ def user_profile(access_token):
         print(f"Error fetching user profile: {response.status_code}, {response.text}")
         return None
 
-def user_liked_songs(access_token):
-    url = "https://api.spotify.com/v1/me/tracks"
+def liked_songs_page(access_token, offset, limit=50):
+    url = f"{SPOTIFY_API_BASE}/me/tracks"
+    headers = {"Authorization": f"Bearer {access_token}"}
+    response = spotify_get(url, headers=headers, params={"offset": offset, "limit": limit})
+
+    if response.status_code == 200:
+        data = response.json()
+        data["items"] = page_items(data)
+        return data
+    print(f"Error fetching user's liked tracks (offset {offset}): {response.status_code}, {response.text}")
+    return None
+
+def page_items(data):
+    # Ensure the "track" object exists; each item becomes (added_at, Track)
+    return [(item.get("added_at"), Track.from_spotify(item["track"])) for item in data.get("items", []) if item.get("track")]
+
+def page_tracks(data):
+    return [track for added_at, track in page_items(data)]
+
+def fetch_all_pages(fetch_page, page_size, workers, on_page=None):
+    """
+    Every item of a paged Spotify list, in order. fetch_page(offset) returns a page (with "items" and
+    "total") or None. The first page tells us how many there are, so the remaining pages are requested
+    all at once, up to workers at a time. None if any page failed. on_page(fetched, total) is called
+    as pages arrive.
+    """
+    first_page = fetch_page(0)
+    if first_page is None:
+        return None
+
+    items = first_page["items"]
+    total = first_page.get("total", 0)
+    offsets = range(page_size, total, page_size)
+    fetched = [len(items)]
+    lock = threading.Lock()
+    if on_page:
+        on_page(fetched[0], total)
+
+    def fetch(offset):
+        page = fetch_page(offset)
+        if page is not None and on_page:
+            with lock:
+                fetched[0] += len(page["items"])
+                on_page(fetched[0], total)
+        return page
+
+    if offsets:
+        with ContextThreadPoolExecutor(max_workers=min(workers, len(offsets))) as pool:
+            pages = list(pool.map(fetch, offsets))
+        # pool.map keeps the offsets order, so e.g. the library stays newest-first
+        for page in pages:
+            if page is None:
+                return None
+            items.extend(page["items"])
+    return items
+
+def liked_songs_progress(progress):
+    # fetch_all_pages' on_page for a pipeline progress callback
+    if not progress:
+        return None
+    return lambda fetched, total: progress("liked_songs", fetched=fetched, total=total)
+
+def liked_song_items(access_token, progress=None):
+    page_size = 50
+    return fetch_all_pages(lambda offset: liked_songs_page(access_token, offset, page_size), page_size,
+                           LIKED_SONGS_WORKERS, liked_songs_progress(progress))
+
+def iter_liked_song_pages(access_token, page_size=50):
+    """
+    Yields liked songs pages (newest first) as they arrive, keeping up to LIKED_SONGS_WORKERS requests
+    in flight. Yields None if a page fails. Closing the generator early cancels the pages not yet requested.
+    """
+    first_page = liked_songs_page(access_token, 0, page_size)
+    yield first_page
+    if first_page is None:
+        return
+
+    offsets = iter(range(page_size, first_page.get("total", 0), page_size))
+    pool = ContextThreadPoolExecutor(max_workers=LIKED_SONGS_WORKERS)
+    try:
+        pending = deque(pool.submit(liked_songs_page, access_token, offset, page_size)
+                        for offset in itertools.islice(offsets, LIKED_SONGS_WORKERS))
+        while pending:
+            page = pending.popleft().result()
+            yield page
+            if page is None:
+                return
+            offset = next(offsets, None)
+            if offset is not None:
+                pending.append(pool.submit(liked_songs_page, access_token, offset, page_size))
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def user_liked_songs(access_token, parallel=True, user_id=None, progress=None):
+    if not parallel:
+        return user_liked_songs_serial(access_token)
+
+    # with a user id we only download what changed since their last visit
+    if user_id and LIKED_SONGS_SNAPSHOTS:
+        items = sync_liked_songs_snapshot(access_token, user_id, progress)
+    else:
+        items = liked_song_items(access_token, progress)
+    if items is None:
+        return None
+    return [track for added_at, track in items]
+
+def user_liked_songs_serial(access_token):
+    url = f"{SPOTIFY_API_BASE}/me/tracks"
     headers = {"Authorization": f"Bearer {access_token}"}
 
     all_tracks = []
 
     #while loop to retrieve all of the user's liked songs (Spotify can only fetch 50 by itself, so we use pagination handling, which helps us fetch data from multiple pages)
     while url:
-        response = requests.get(url, headers=headers)
+        response = spotify_get(url, headers=headers)
         
         if response.status_code == 200:
             data = response.json()
-            tracks = data.get("items", [])
-            
-            for item in tracks:
-                track = item.get("track")
-                if track:  # Ensure the "track" object exists
-                    all_tracks.append(track)
+            all_tracks.extend(page_tracks(data))
             
             # Check if there is another page of results (i.e. more liked songs)
             url = data.get("next")
@@ -97,26 +793,200 @@ def user_liked_songs(access_token):
 
     return all_tracks
 
-def user_top_tracks(access_token):
-    url = "https://api.spotify.com/v1/me/top/tracks"
+############################## LIKED SONGS SNAPSHOTS ##############################
+
+# Each user's library is saved (compactly) after a fetch, so the next visit only downloads newly liked songs
+LIKED_SONGS_SNAPSHOTS = os.getenv("LIKED_SONGS_SNAPSHOTS", "1") != "0"
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", os.path.join(tempfile.gettempdir(), "soundcheck-snapshots"))
+
+def snapshot_path(user_id):
+    safe_id = re.sub(r'[^A-Za-z0-9_.-]', '_', user_id)
+    return os.path.join(SNAPSHOT_DIR, f"{safe_id}.json")
+
+SNAPSHOT_VERSION = 2
+
+def load_liked_snapshot(user_id):
+    """Returns the saved [(added_at, Track), ...] or None."""
+    try:
+        with open(snapshot_path(user_id)) as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        return None
+    return [(added_at, Track.from_json(track)) for added_at, track in snapshot["items"]]
+
+def save_liked_snapshot(user_id, items):
+    #only the fields used to match songs and build the playlist
+    snapshot = {"version": SNAPSHOT_VERSION, "items": [[added_at, track.to_json()] for added_at, track in items]}
+    try:
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        path = snapshot_path(user_id)
+        # write + rename, so a concurrent reader never sees half a file
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(snapshot, f, separators=(",", ":"))
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Could not save liked songs snapshot for {user_id}: {e}")
+    return items
+
+def sync_liked_songs_snapshot(access_token, user_id, progress=None):
+    """
+    /me/tracks is newest-first, so pages are read until we reach a song already in the snapshot,
+    and the new songs are put in front of it. If the merged library doesn't add up to Spotify's
+    total, songs were removed since the snapshot, so everything is fetched again.
+    """
+    snapshot = load_liked_snapshot(user_id)
+    if not snapshot:
+        items = liked_song_items(access_token, progress)
+        return None if items is None else save_liked_snapshot(user_id, items)
+
+    known = snapshot_keys(snapshot)
+    new_items = []
+    page_size = 50
+    offset = 0
+    while True:
+        page = liked_songs_page(access_token, offset, page_size)
+        if page is None:
+            return None
+        offset += page_size
+        if not new_liked_items(known, page, new_items, offset):
+            break
+
+    merged = merge_liked_snapshot(user_id, snapshot, new_items, page.get("total"), progress)
+    if merged is None:
+        items = liked_song_items(access_token, progress)
+        return None if items is None else save_liked_snapshot(user_id, items)
+    return merged
+
+# The parts of a snapshot sync that don't talk to Spotify, shared with sync_liked_songs_snapshot_async
+
+def snapshot_keys(snapshot):
+    return {(added_at, track.uri) for added_at, track in snapshot}
+
+def new_liked_items(known, page, new_items, next_offset):
+    """Adds the page's songs liked since the snapshot to new_items; True if the next page has to be read too."""
+    items = page["items"]
+    for i, (added_at, track) in enumerate(items):
+        if (added_at, track.uri) in known:
+            new_items.extend(items[:i])
+            return False
+    new_items.extend(items)
+    return bool(page.get("next")) and next_offset < page.get("total", 0)
+
+def merge_liked_snapshot(user_id, snapshot, new_items, total, progress=None):
+    """
+    new_items + snapshot, saved if anything was added. None if that doesn't add up to Spotify's total:
+    songs were removed since the snapshot, so the caller has to fetch everything again.
+    """
+    merged = new_items + snapshot
+    if total is not None and len(merged) != total:
+        print(f"Liked songs snapshot for {user_id} is out of date, fetching the whole library")
+        return None
+
+    if progress:
+        progress("liked_songs", fetched=len(merged), total=len(merged))
+    if new_items:
+        return save_liked_snapshot(user_id, merged)
+    return merged
+
+def user_top_tracks(access_token, time_range="medium_term"):
+    url = f"{SPOTIFY_API_BASE}/me/top/tracks"
     headers = {"Authorization": f"Bearer {access_token}"}
 
-    params = {"time_range":"medium_term", "limit": 50} #default limit of 50 tracks per request
+    params = {"time_range": time_range, "limit": 50} #default limit of 50 tracks per request
     
-    response = requests.get(url, headers=headers, params=params)
+    response = spotify_get(url, headers=headers, params=params)
     
     if response.status_code == 200:
-        return response.json()["items"]
+        return parse_tracks(response.json()["items"])
     else:
-        print(f"Error fetching user's top tracks: {response.status_code}, {response.text}")
+        print(f"Error fetching user's top tracks ({time_range}): {response.status_code}, {response.text}")
+        return None
+
+############################## OTHER SONGS THE USER KNOWS ##############################
+
+# Where the songs a user knows come from besides their liked songs (comma separated):
+#   top    - top tracks of the last 4 weeks, 6 months and all time (without it: just the last 6 months)
+#   recent - the last 50 songs they played
+#   albums - every track of their saved albums
+KNOWN_SONG_SOURCES = {part.strip() for part in os.getenv("KNOWN_SONG_SOURCES", "top,recent,albums").split(",") if part.strip()}
+TOP_TRACK_RANGES = ("short_term", "medium_term", "long_term")
+
+def recently_played_tracks(access_token):
+    url = f"{SPOTIFY_API_BASE}/me/player/recently-played"
+    headers = {"Authorization": f"Bearer {access_token}"}
+    response = spotify_get(url, headers=headers, params={"limit": 50})
+    if response.status_code == 200:
+        return parse_tracks(item.get("track") for item in response.json().get("items", []))
+    print(f"Error fetching user's recently played tracks: {response.status_code}, {response.text}")
+    return None
+
+def saved_album_tracks_page(access_token, offset, limit=50):
+    url = f"{SPOTIFY_API_BASE}/me/albums"
+    headers = {"Authorization": f"Bearer {access_token}"}
+    response = spotify_get(url, headers=headers, params={"offset": offset, "limit": limit})
+    if response.status_code == 200:
+        data = response.json()
+        data["items"] = saved_album_page_tracks(data)
+        return data
+    print(f"Error fetching user's saved albums (offset {offset}): {response.status_code}, {response.text}")
+    return None
+
+def saved_album_page_tracks(data):
+    # each saved album comes with its first 50 tracks, which is every track of nearly every album
+    return [track for item in data.get("items", [])
+            for track in parse_tracks(((item.get("album") or {}).get("tracks") or {}).get("items"))]
+
+def saved_album_tracks(access_token):
+    page_size = 50
+    return fetch_all_pages(lambda offset: saved_album_tracks_page(access_token, offset, page_size), page_size, LIKED_SONGS_WORKERS)
+
+def dedupe_tracks(tracks):
+    """tracks in order without repeats of a uri or ISRC - sets, so merging the sources stays linear."""
+    seen_uris, seen_isrcs, unique = set(), set(), []
+    for track in tracks:
+        if track is None or track.uri in seen_uris or (track.isrc and track.isrc in seen_isrcs):
+            continue
+        seen_uris.add(track.uri)
+        if track.isrc:
+            seen_isrcs.add(track.isrc)
+        unique.append(track)
+    return unique
+
+def merge_known_tracks(results):
+    """
+    results: {source: tracks or None} from the fetches below. The 6-month top tracks are required (None
+    if they failed, like before); any other source that failed is left out.
+    """
+    if results.get("medium_term") is None:
         return None
+    order = [r for r in TOP_TRACK_RANGES if r in results] + [source for source in results if source not in TOP_TRACK_RANGES]
+    return dedupe_tracks(track for source in order for track in results[source] or ())
+
+def user_known_tracks(access_token):
+    """
+    Songs the user knows besides their liked songs: top tracks of every time range, recently played and
+    saved albums' tracks (see KNOWN_SONG_SOURCES), all fetched at the same time and deduplicated.
+    Top tracks come first. None if the 6-month top tracks couldn't be fetched.
+    """
+    ranges = TOP_TRACK_RANGES if "top" in KNOWN_SONG_SOURCES else ("medium_term",)
+    with ContextThreadPoolExecutor(max_workers=len(ranges) + 2) as pool:
+        futures = {time_range: pool.submit(user_top_tracks, access_token, time_range) for time_range in ranges}
+        if "recent" in KNOWN_SONG_SOURCES:
+            futures["recent"] = pool.submit(recently_played_tracks, access_token)
+        if "albums" in KNOWN_SONG_SOURCES:
+            futures["albums"] = pool.submit(saved_album_tracks, access_token)
+        return merge_known_tracks({source: future.result() for source, future in futures.items()})
 
  
 
 ############################## RETRIEVE ARTIST'S TOP TRACKS FROM PAST 6 MONTHS ##############################
 
+@cached_across_users("artist_id", ["artist_name"])
 def get_artist_id(access_token, artist_name):
-    url = "https://api.spotify.com/v1/search"
+    url = f"{SPOTIFY_API_BASE}/search"
     headers = {
         "Authorization": f"Bearer {access_token}"
     }
@@ -125,7 +995,7 @@ def get_artist_id(access_token, artist_name):
         "type": "artist",
         "limit": 50
     }
-    response = requests.get(url, headers=headers, params=params)
+    response = spotify_get(url, headers=headers, params=params)
     
     if response.status_code == 200:
         data = response.json()
@@ -134,6 +1004,10 @@ def get_artist_id(access_token, artist_name):
             if artist_name.strip().lower() == artist["name"].strip().lower():
                 return artist["id"], artist["name"]
         
+        if not data["artists"]["items"]:
+            print(f"No artist found for '{artist_name}'")
+            return None, None
+
         print(f"Warning: No exact match found for '{artist_name}', showing first result.")
         # Return the first available result as fallback
         artist = data["artists"]["items"][0]
@@ -142,148 +1016,237 @@ def get_artist_id(access_token, artist_name):
         print(f"Error searching for artist: {response.status_code}, {response.text}")
         return None, None
 
+@cached_across_users("artist_top_tracks", ["artist_id"])
 def artist_top_tracks(access_token, artist_id, artist_name):
-    url = f"https://api.spotify.com/v1/artists/{artist_id}/top-tracks"
+    url = f"{SPOTIFY_API_BASE}/artists/{artist_id}/top-tracks"
     headers = {"Authorization": f"Bearer {access_token}"}
 
     params = {"market": "US"}  # Market parameter is required for top-tracks endpoint
 
-    response = requests.get(url, headers=headers, params=params)
+    response = spotify_get(url, headers=headers, params=params)
     
     if response.status_code == 200:
-        return response.json()["tracks"]
+        return parse_tracks(response.json()["tracks"])
     else:
         print(f"Error fetching {artist_name}'s top tracks: {response.status_code}, {response.text}")
         return None
 
 ############################## RETRIEVE SETLIST ##############################
 
-#Enhancement: If no matching playlist is found, return all playlists containing "setlist" and let the user choose manually.
-def find_setlist(access_token, artist_name, concert_name=None, year=None):
-    # API endpoint; concert_name and year are optional
-    search_url = "https://api.spotify.com/v1/search"
+# Only the track fields unheard_tracks needs
+PLAYLIST_TRACK_FIELDS = "total,items(track(uri,name,duration_ms,external_ids(isrc),artists(id,name)))"
 
-    search_parts = [artist_name]
-    if concert_name:
-        search_parts.append(concert_name)
-    search_parts.append("Setlist")
-    if year:
-        search_parts.append(year)
+def playlist_tracks_page(access_token, playlist_id, offset, limit=100):
+    url = f"{SPOTIFY_API_BASE}/playlists/{playlist_id}/tracks"
+    headers = {"Authorization": f"Bearer {access_token}"}
+    params = {"offset": offset, "limit": limit, "fields": PLAYLIST_TRACK_FIELDS}
+    response = spotify_get(url, headers=headers, params=params)
 
-    params = {
-        "q": " ".join(search_parts),
-        "type": "playlist",
-        "limit": 50
-    }
+    if response.status_code == 200:
+        data = response.json()
+        data["items"] = parse_tracks(item.get("track") for item in data.get("items", []))
+        return data
+    print(f"Error fetching playlist tracks (offset {offset}): {response.status_code}, {response.text}")
+    return None
 
-    headers = {
-        "Authorization": f"Bearer {access_token}"
+def playlist_tracks(access_token, playlist_id):
+    """Every track in the playlist, in order. Spotify returns at most 100 per request, so the rest are fetched at once."""
+    page_size = 100
+    return fetch_all_pages(lambda offset: playlist_tracks_page(access_token, playlist_id, offset, page_size),
+                           page_size, SETLIST_DETAIL_WORKERS)
+
+# Setlist candidates are ranked on their name, then details (follower counts) are fetched in rank order,
+# a batch at a time, until no candidate left could beat the best one so far. Followers add at most
+# SETLIST_FOLLOWER_BONUS points (one per 10x followers), so a playlist can only lose to a worse-named one
+# by that much. At most SETLIST_MAX_DETAILS playlists are looked at.
+SETLIST_FOLLOWER_BONUS = float(os.getenv("SETLIST_FOLLOWER_BONUS", "5"))
+SETLIST_MAX_DETAILS = int(os.getenv("SETLIST_MAX_DETAILS", "16"))
+# How long the playlist chosen for an (artist, tour, year) is reused without searching again
+SETLIST_ID_TTL = int(os.getenv("SETLIST_ID_TTL", str(7 * 24 * 60 * 60)))
+SETLIST_KEYWORDS = {"setlist", "setlists", "concert", "concerts", "tour", "tours"}
+
+def name_tokens(text):
+    return set(re.findall(r"\w+", (text or "").lower()))
+
+def rank_setlist_candidates(playlists, artist_name, concert_name=None, year=None):
+    """
+    [(score, playlist)] for the search results that look like a setlist for the artist, best first.
+    A name must have a word of the artist's name and setlist/concert/tour; concert words (+10 each),
+    the year (+5), the full artist name (+2) and "setlist" itself (+1) raise the score.
+    """
+    artist_words = name_tokens(artist_name)
+    concert_words = name_tokens(concert_name)
+    year = str(year or "").strip()
+
+    ranked = []
+    for playlist in playlists:
+        if not playlist or not playlist.get('name'):
+            continue
+        words = name_tokens(playlist['name'])  # tokenized once per playlist
+        if not words & artist_words or not words & SETLIST_KEYWORDS:
+            continue
+        score = 10 * len(words & concert_words)
+        if year and year in words:
+            score += 5
+        if artist_words <= words:
+            score += 2
+        if "setlist" in words or "setlists" in words:
+            score += 1
+        ranked.append((score, playlist))
+    # stable: equal scores keep spotify's search order
+    ranked.sort(key=lambda ranked_playlist: -ranked_playlist[0])
+    return ranked
+
+def follower_bonus(followers):
+    return min(SETLIST_FOLLOWER_BONUS, math.log10(max(followers, 0) + 1))
+
+def setlist_details(access_token, playlist_id):
+    """{"name", "followers", "url", "id"} for a playlist, only asking for the fields we read; None on error."""
+    url = f"{SPOTIFY_API_BASE}/playlists/{playlist_id}"
+    headers = {"Authorization": f"Bearer {access_token}"}
+    response = spotify_get(url, headers=headers, params={"fields": "followers.total,name,external_urls"})
+    if response.status_code != 200:
+        print(f"Error fetching playlist {playlist_id}: {response.status_code}, {response.text}")
+        return None
+    details = response.json()
+    return {
+        "name": details['name'],
+        "followers": (details.get('followers') or {}).get('total', 0),
+        "url": details['external_urls']['spotify'],
+        "id": playlist_id,
     }
 
-    response = requests.get(search_url, headers=headers, params=params)
+class SetlistPicker:
+    """
+    The comparison behind pick_setlist (and pick_setlist_async) without the requests: batches() yields the
+    candidates to fetch details for, in rank order, until none left could beat the best one add()ed so far.
+    """
+
+    def __init__(self, ranked, batch_size=SETLIST_DETAIL_WORKERS):
+        # the top-ranked playlist scores at least its name score, so anything that can't pass it even with
+        # the biggest follower bonus is out before a single details request
+        top_score = ranked[0][0]
+        self.ranked = [(score, playlist) for score, playlist in ranked if score + SETLIST_FOLLOWER_BONUS > top_score]
+        self.batch_size = max(1, batch_size)
+        self.best, self.best_score = None, None
+
+    def only_candidate(self):
+        """Details of the one candidate left (from its search result, no request needed), or None if there are more."""
+        if len(self.ranked) != 1:
+            return None
+        playlist = self.ranked[0][1]
+        return {
+            "name": playlist['name'],
+            "followers": (playlist.get('followers') or {}).get('total', 0),
+            "url": playlist['external_urls']['spotify'],
+            "id": playlist['id'],
+        }
 
-    if response.status_code == 200:
-        data = response.json()
-        playlists = data.get('playlists', {}).get('items', [])
+    def batches(self):
+        ranked = self.ranked[:SETLIST_MAX_DETAILS]
+        for start in range(0, len(ranked), self.batch_size):
+            # nothing from here on can beat the best: its name score + the biggest possible follower bonus is too low
+            if self.best is not None and ranked[start][0] + SETLIST_FOLLOWER_BONUS <= self.best_score:
+                return
+            yield ranked[start:start + self.batch_size]
+
+    def add(self, batch, details):
+        # in rank order, so ties still go to the better-named playlist
+        for (score, playlist), detail in zip(batch, details):
+            if detail is None:
+                continue
+            combined = score + follower_bonus(detail["followers"])
+            if self.best is None or combined > self.best_score:
+                self.best, self.best_score = detail, combined
+
+def pick_setlist(access_token, ranked):
+    """The best of the ranked candidates on name score + follower bonus, fetching as few details as possible."""
+    picker = SetlistPicker(ranked)
+    only = picker.only_candidate()
+    if only:
+        # Only one candidate: no follower comparison needed, the search result has everything we use
+        return only
+
+    with ContextThreadPoolExecutor(max_workers=min(picker.batch_size, len(picker.ranked))) as pool:
+        for batch in picker.batches():
+            picker.add(batch, pool.map(lambda scored: setlist_details(access_token, scored[1]['id']), batch))
+    return picker.best
+
+def setlist_id_key(artist_name, concert_name, year):
+    return "|".join(["setlist_id"] + [normalize_key_part(part) for part in (artist_name, concert_name, year)])
+
+def remembered_setlist_id(artist_name, concert_name=None, year=None):
+    entry = shared_cache.backend.get(setlist_id_key(artist_name, concert_name, year))
+    if entry is not None and time.time() - entry[1] < SETLIST_ID_TTL:
+        return entry[0]
+    return None
 
+def remember_setlist_id(artist_name, concert_name, year, playlist_id):
+    shared_cache.backend.set(setlist_id_key(artist_name, concert_name, year), playlist_id, time.time())
+
+#Enhancement: If no matching playlist is found, return all playlists containing "setlist" and let the user choose manually.
+@cached_across_users("setlist", ["artist_name", "concert_name", "year"])
+def find_setlist(access_token, artist_name, concert_name=None, year=None):
+    # concert_name and year are optional
+    most_followed_playlist = None
+
+    # the playlist picked last time for this show skips the search and the follower comparison
+    playlist_id = remembered_setlist_id(artist_name, concert_name, year)
+    if playlist_id:
+        most_followed_playlist = setlist_details(access_token, playlist_id)
+
+    if most_followed_playlist is None:
+        search_url = f"{SPOTIFY_API_BASE}/search"
+
+        search_parts = [artist_name]
+        if concert_name:
+            search_parts.append(concert_name)
+        search_parts.append("Setlist")
+        if year:
+            search_parts.append(year)
+
+        params = {
+            "q": " ".join(search_parts),
+            "type": "playlist",
+            "limit": 50
+        }
+
+        headers = {
+            "Authorization": f"Bearer {access_token}"
+        }
+
+        response = spotify_get(search_url, headers=headers, params=params)
+        if response.status_code != 200:
+            print(f"Error: {response.status_code}, {response.text}")
+            return None, None, None
+
+        playlists = response.json().get('playlists', {}).get('items', [])
         if not playlists:
             print("No playlists found.")
             return None, None
 
-        name_split = artist_name.lower().split()
-        conc_split = (concert_name or "").lower().split()
-
         # Filter: artist + setlist/concert/tour required; concert and year are optional hints
-        # We prioritize matches with concert/year but still return good matches without them
-        def matches(playlist):
-            if not playlist or not playlist.get('name'):
-                return False
-            name_lower = playlist['name'].lower()
-            # Must have artist name
-            if not any(part in name_lower for part in name_split):
-                return False
-            # Must have setlist/concert/tour keyword
-            if 'setlist' not in name_lower and 'concert' not in name_lower and 'tour' not in name_lower:
-                return False
-            return True
-
-        def score(playlist):
-            """Score playlists - higher is better. Prioritize matches with concert/year."""
-            if not playlist or not playlist.get('name'):
-                return 0
-            name_lower = playlist['name'].lower()
-            score = 0
-            # Bonus for matching concert name (if provided)
-            if conc_split:
-                for part in conc_split:
-                    if part in name_lower:
-                        score += 10
-            # Bonus for matching year (if provided)
-            if year and year in playlist['name']:
-                score += 5
-            return score
-
-        # Filter to valid playlists
-        valid_playlists = [p for p in playlists if matches(p)]
-        
-        if not valid_playlists:
+        ranked = rank_setlist_candidates(playlists, artist_name, concert_name, year)
+        if not ranked:
             print("No playlists match the criteria.")
             return None, None
 
-        # Sort by score (best matches first), then we'll pick the one with most followers
-        scored_playlists = [(score(p), p) for p in valid_playlists]
-        scored_playlists.sort(reverse=True, key=lambda x: x[0])
-        
-        # Use top-scored playlists (within top score range) for follower comparison
-        if scored_playlists:
-            top_score = scored_playlists[0][0]
-            # Consider playlists within 5 points of top score
-            filtered_playlists = [p for s, p in scored_playlists if s >= max(0, top_score - 5)]
-        else:
-            filtered_playlists = valid_playlists
-
-        # Find the playlist with the most followers
-        most_followed_playlist = None
-        max_followers = 0
-
-        for playlist in filtered_playlists:
-            playlist_id = playlist['id']
-            details_url = f"https://api.spotify.com/v1/playlists/{playlist_id}"
-            details_response = requests.get(details_url, headers=headers)
-
-            if details_response.status_code == 200:
-                details = details_response.json()
-                followers = details['followers']['total']
-                if followers > max_followers:
-                    max_followers = followers
-                    most_followed_playlist = {
-                        "name": details['name'],
-                        "followers": followers,
-                        "url": details['external_urls']['spotify'],
-                        "id" : playlist_id,
-                    }
-
-        if most_followed_playlist:
-            print(f"Most followed playlist: {most_followed_playlist['name']}")
-            print(f"Saves: {most_followed_playlist['followers']}")
-            print(f"URL: {most_followed_playlist['url']}")
-        else:
+        most_followed_playlist = pick_setlist(access_token, ranked)
+        if not most_followed_playlist:
             print("No playlists found.")
             return None, None, None
+        remember_setlist_id(artist_name, concert_name, year, most_followed_playlist["id"])
 
-        url = f"https://api.spotify.com/v1/playlists/{most_followed_playlist['id']}/tracks"
-        headers = {
-            "Authorization": f"Bearer {access_token}"
-        }
-        response = requests.get(url, headers=headers)
-        tracks = response.json()["items"]
-        actual_tour_title = most_followed_playlist["name"]
-        setlist_url = most_followed_playlist["url"]
-        return tracks, actual_tour_title, setlist_url
+    print(f"Most followed playlist: {most_followed_playlist['name']}")
+    print(f"Saves: {most_followed_playlist['followers']}")
+    print(f"URL: {most_followed_playlist['url']}")
 
-    else:
-        print(f"Error: {response.status_code}, {response.text}")
+    tracks = playlist_tracks(access_token, most_followed_playlist['id'])
+    if tracks is None:
         return None, None, None
+    actual_tour_title = most_followed_playlist["name"]
+    setlist_url = most_followed_playlist["url"]
+    return tracks, actual_tour_title, setlist_url
 
 
 ############################## COMPARE USER'S LISTENED TRACKS TO ARTIST TRACKS + SETLIST ##############################
@@ -297,73 +1260,323 @@ def find_setlist(access_token, artist_name, concert_name=None, year=None):
 #                 tracks_by_artist.append(track)
 #     return tracks_by_artist
 
+# Word overlap (0-1) at which two titles by the same artist count as the same song, e.g. 0.8.
+# 0 turns it off, so only exact normalized titles match
+FUZZY_MATCH_THRESHOLD = float(os.getenv("FUZZY_MATCH_THRESHOLD", "0"))
+
+class TitleIndex:
+    """
+    Normalized titles by artist -> items. Exact (artist, title) lookups are a dict hit; with a threshold,
+    titles by the same artist sharing a word with the query (inverted index) are scored by word overlap,
+    so a lookup only ever looks at that artist's songs.
+    """
+
+    def __init__(self, threshold=FUZZY_MATCH_THRESHOLD):
+        self.threshold = threshold
+        self.exact = {}
+        self.postings = {}
+
+    def add(self, artists, title, item):
+        for artist in artists:
+            self.exact.setdefault((artist, title), []).append(item)
+            if self.threshold:
+                for word in title.split():
+                    self.postings.setdefault((artist, word), set()).add(title)
+
+    def find(self, artists, title):
+        found = []
+        for artist in artists:
+            found.extend(self.exact.get((artist, title), ()))
+        if found or not self.threshold:
+            return found
+
+        words = set(title.split())
+        for artist in artists:
+            similar = set()
+            for word in words:
+                similar |= self.postings.get((artist, word), set())
+            for other in similar:
+                other_words = set(other.split())
+                if len(words & other_words) / len(words | other_words) >= self.threshold:
+                    found.extend(self.exact[(artist, other)])
+        return found
+
+class KnownSongIndex:
+    """
+    Set-backed index of the songs a user knows. Built once per request so each lookup is O(1).
+    A song is known if its uri, ISRC or name + artists match, or if a known song by its primary artist
+    has the same normalized title (remasters, live versions, extra featured artists).
+    """
+
+    def __init__(self, tracks=()):
+        self.keys = set()
+        self.uris = set()
+        self.isrcs = set()
+        self.titles = set()
+        self.similar = TitleIndex() if FUZZY_MATCH_THRESHOLD else None
+        self.update(tracks)
+
+    def add(self, track):
+        track = as_track(track)
+        if track is None:
+            return
+        self.keys.add(track.key)
+        if track.uri:
+            self.uris.add(track.uri)
+        if track.isrc:
+            self.isrcs.add(track.isrc)
+        for artist in track.artist_names:
+            self.titles.add((artist, track.title))
+        if self.similar:
+            self.similar.add(track.artist_names, track.title, True)
+
+    def update(self, tracks):
+        for track in tracks or ():
+            self.add(track)
+
+    def __contains__(self, track):
+        track = as_track(track)
+        if track is None:
+            return False
+        if track.uri in self.uris:
+            return True
+        if track.isrc and track.isrc in self.isrcs:
+            return True
+        if track.key in self.keys or (track.primary_artist, track.title) in self.titles:
+            return True
+        return bool(self.similar and track.primary_artist and self.similar.find((track.primary_artist,), track.title))
+
+    def __len__(self):
+        return len(self.keys)
+
+class CandidateMatcher:
+    """
+    The other way round from KnownSongIndex: indexes the (small) set of candidate songs - artist top
+    tracks + setlist - so liked songs can be streamed past it and strike off the candidates they match.
+    """
+
+    def __init__(self, candidates):
+        self.remaining = {}
+        self.lookup = {}
+        self.titles = TitleIndex()
+        for track in candidates:
+            track = as_track(track)
+            if track is None:
+                continue
+            i = len(self.remaining)
+            self.remaining[i] = track
+            for key in (("uri", track.uri), ("isrc", track.isrc), ("key", track.key)):
+                if key[1]:
+                    self.lookup.setdefault(key, []).append(i)
+            # same rule as KnownSongIndex: a known song matches on the candidate's primary artist
+            if track.primary_artist:
+                self.titles.add((track.primary_artist,), track.title, i)
+
+    def strike(self, track):
+        """Removes every candidate matching track; returns True if there was one."""
+        matched = False
+        ids = [i for key in (("uri", track.uri), ("isrc", track.isrc), ("key", track.key)) for i in self.lookup.get(key, ())]
+        ids.extend(self.titles.find(track.artist_names, track.title))
+        for i in ids:
+            if self.remaining.pop(i, None) is not None:
+                matched = True
+        return matched
+
+    def done(self):
+        return not self.remaining
+
+def stream_known_songs(access_token, candidates, top_user_tracks, progress=None):
+    """
+    Streams the user's liked songs past the candidates and stops downloading as soon as every candidate
+    is known. Returns (the liked songs that matched a candidate, how many liked songs the user has),
+    or (None, 0) on error. The matched songs are all unheard_tracks needs to know about.
+    """
+    matcher = CandidateMatcher(candidates)
+    for track in top_user_tracks or ():
+        matcher.strike(track)
+
+    known = []
+    scanned = 0
+    total = 0
+    pages = iter_liked_song_pages(access_token)
+    try:
+        for page in pages:
+            if page is None:
+                return None, 0
+            total = page.get("total", total)
+            for added_at, track in page["items"]:
+                scanned += 1
+                if matcher.strike(track):
+                    known.append(track)
+            if progress:
+                progress("liked_songs", fetched=scanned, total=total)
+            if matcher.done():
+                print(f"Every candidate is already known after {scanned} of {total} liked songs, stopped early")
+                break
+    finally:
+        pages.close()
+    return known, total
+
+def track_id(track):
+    # "spotify:track:<id>" -> "<id>"
+    return track.uri.rsplit(":", 1)[-1] if track.uri and track.uri.startswith("spotify:track:") else None
+
+def saved_track_flags(access_token, track_ids):
+    """Which of track_ids are in the user's liked songs: {id: bool}, or None on error. 50 ids per request."""
+    url = f"{SPOTIFY_API_BASE}/me/tracks/contains"
+    headers = {"Authorization": f"Bearer {access_token}"}
+    batches = [track_ids[i:i + 50] for i in range(0, len(track_ids), 50)]
+
+    def check(batch):
+        response = spotify_get(url, headers=headers, params={"ids": ",".join(batch)})
+        if response.status_code == 200:
+            return dict(zip(batch, response.json()))
+        print(f"Error checking user's liked tracks: {response.status_code}, {response.text}")
+        return None
+
+    flags = {}
+    with ContextThreadPoolExecutor(max_workers=max(1, min(LIKED_SONGS_WORKERS, len(batches)))) as pool:
+        for result in pool.map(check, batches):
+            if result is None:
+                return None
+            flags.update(result)
+    return flags
+
+def liked_songs_total(access_token):
+    page = liked_songs_page(access_token, 0, 1)
+    return None if page is None else page.get("total", 0)
+
+@cached_across_users("alternate_releases", ["name", "artist"])
+def alternate_releases(access_token, name, artist):
+    """Other releases (album version, single, deluxe...) of the same song, found by searching name + artist."""
+    url = f"{SPOTIFY_API_BASE}/search"
+    headers = {"Authorization": f"Bearer {access_token}"}
+    params = {"q": f'track:"{name}" artist:"{artist}"', "type": "track", "limit": 20}
+    response = spotify_get(url, headers=headers, params=params)
+
+    if response.status_code == 200:
+        return parse_tracks(response.json().get("tracks", {}).get("items", []))
+    print(f"Error searching for other releases of {name}: {response.status_code}, {response.text}")
+    return None
+
+def check_known_songs(access_token, candidates, top_user_tracks, progress=None, resolve_alternates=True):
+    """
+    Finds which candidates the user knows without reading their library: one /me/tracks/contains
+    call per 50 candidates. A song liked from a different release has a different URI, so the
+    candidates left over are searched for their other releases (same name + artists, or same ISRC)
+    and those are checked too. Same return value as stream_known_songs.
+    """
+    matcher = CandidateMatcher(candidates)
+    for track in top_user_tracks or ():
+        matcher.strike(track)
+
+    with ContextThreadPoolExecutor(max_workers=2) as pool:
+        total_future = pool.submit(liked_songs_total, access_token)
+        ids = list(dict.fromkeys(filter(None, (track_id(t) for t in matcher.remaining.values()))))
+        flags = saved_track_flags(access_token, ids)
+        total = total_future.result()
+    if flags is None or total is None:
+        return None, 0
+
+    known = []
+    for track in list(matcher.remaining.values()):
+        if flags.get(track_id(track)) and matcher.strike(track):
+            known.append(track)
+
+    if resolve_alternates and not matcher.done():
+        # one search per distinct song still unmatched
+        songs = {t.key: t for t in matcher.remaining.values() if t.artist_names}
+        with ContextThreadPoolExecutor(max_workers=max(1, min(LIKED_SONGS_WORKERS, len(songs)))) as pool:
+            found = pool.map(lambda t: alternate_releases(access_token, t.name, t.artist_names[0]), songs.values())
+            alternates = {}
+            for track, releases in zip(songs.values(), found):
+                for release in releases or ():
+                    if release.uri != track.uri and (release.key == track.key or (release.isrc and release.isrc == track.isrc)):
+                        alternates[track_id(release)] = release
+        alternates.pop(None, None)
+
+        flags = saved_track_flags(access_token, list(alternates)) if alternates else {}
+        for release_id, saved in (flags or {}).items():
+            if saved and matcher.strike(alternates[release_id]):
+                known.append(alternates[release_id])
+
+    return known, total
+
 def track_in_list(track, track_list):
     #this line doesn't consider when the same song is released in diff albums
     #return any(track['uri'] == t.get('uri') for t in track_list) #any is the same as seeing if the track matches any track in the given track_list
 
-
     #to check if the consumed track exists in the consumed track_list, we search for any tracks with the same name + artists
-    if not track or not isinstance(track, dict):
-        return False
-    
-    name = track.get('name', '').lower().strip()
+    #NOTE: builds an index on every call - for repeated lookups build a KnownSongIndex once instead
+    return track in KnownSongIndex(track_list)
 
-    artists = {a['name'].lower().strip() for a in track.get('artists', []) if a and a.get('name')}
-    
-    return any(t['name'].lower().strip() == track['name'].lower().strip() and
-               {a['name'].lower().strip() for a in t.get('artists', []) if a and a.get('name')} == artists
-               for t in track_list)
-
-def unheard_tracks(user_id, access_token, liked_songs, top_user_tracks, top_artist_tracks, setlist, artist_name, actual_tour_title=None):
+def plan_prep_playlist(liked_songs, top_user_tracks, top_artist_tracks, setlist, artist_name, actual_tour_title=None):
     """
-    artist_name: must be the looked-up Spotify artist name (never user input).
-    actual_tour_title: setlist playlist name when found; never use user's concert/tour input.
+    The prep playlist's songs, title and description: (uris, title, description). uris is empty when
+    the user knows everything already. Same arguments as unheard_tracks.
     """
-    known_songs = liked_songs + [track for track in top_user_tracks if track not in liked_songs]
+    known_songs = KnownSongIndex(liked_songs)
+    known_songs.update(top_user_tracks)
 
     # filter tracks + extract URIs only for unknown songs
     unknown_songs_uris = []
+    # songs already added, so a live/remastered version of one isn't added again
+    added = KnownSongIndex()
     
     # Add artist's top tracks that user hasn't heard
     for i in top_artist_tracks:
-        if i and not track_in_list(i, known_songs):
-            unknown_songs_uris.append(i['uri'])
+        if i and i not in known_songs and i not in added:
+            added.add(i)
+            unknown_songs_uris.append(i.uri)
                      
     # Add setlist tracks that user hasn't heard
     if setlist:
-        for i in setlist:
-            track = i.get('track', {})
-            if track and not track_in_list(track, known_songs):
-                if track.get('uri') not in unknown_songs_uris:
-                    unknown_songs_uris.append(track.get('uri'))
+        for track in setlist:
+            if track and track not in known_songs:
+                if track not in added:
+                    added.add(track)
+                    unknown_songs_uris.append(track.uri)
 
-    if not unknown_songs_uris:
-        return f"No new songs to add! You already know all the songs from {artist_name}'s setlist and top tracks."
-    
-    # Only use looked-up tour title from setlist; never user input
+    playlist_title = prep_playlist_title(artist_name, actual_tour_title)
     if actual_tour_title:
-        # Extract year from tour title if present
-        year_match = re.search(r'\b(20\d{2})\b', actual_tour_title)
-        year_str = f" ({year_match.group(1)})" if year_match else ""
-        
-        # Clean up the title - remove redundant "Setlist" and artist name if already present
-        clean_title = actual_tour_title
-        # Remove "Setlist" if present since we'll add "Prep"
-        clean_title = re.sub(r'\bSetlist\s*-?\s*', '', clean_title, flags=re.IGNORECASE)
-        # Remove artist name if it's at the end
-        clean_title = re.sub(rf'\s*-?\s*{re.escape(artist_name)}\s*$', '', clean_title, flags=re.IGNORECASE)
-        clean_title = clean_title.strip(' -')
-        
-        playlist_title = f"{clean_title} Prep"
-        
-        # Clean description - use clean_title instead of actual_tour_title
         description = f"Songs from {artist_name} you haven't heard yet. Perfect for learning before the show!"
     else:
-        playlist_title = f"{artist_name} Concert Prep"
         description = ""
 
+    return unknown_songs_uris, playlist_title, description
+
+def prep_playlist_title(artist_name, actual_tour_title=None):
+    """The prep playlist's name: the cleaned up setlist title + " Prep", or "<artist> Concert Prep" without one."""
+    # Only use looked-up tour title from setlist; never user input
+    if not actual_tour_title:
+        return f"{artist_name} Concert Prep"
+
+    # Clean up the title - remove redundant "Setlist" and artist name if already present
+    clean_title = actual_tour_title
+    # Remove "Setlist" if present since we'll add "Prep"
+    clean_title = re.sub(r'\bSetlist\s*-?\s*', '', clean_title, flags=re.IGNORECASE)
+    # Remove artist name if it's at the end
+    clean_title = re.sub(rf'\s*-?\s*{re.escape(artist_name)}\s*$', '', clean_title, flags=re.IGNORECASE)
+    clean_title = clean_title.strip(' -')
+    return f"{clean_title} Prep"
+
+def unheard_tracks(user_id, access_token, liked_songs, top_user_tracks, top_artist_tracks, setlist, artist_name, actual_tour_title=None, progress=None):
+    """
+    artist_name: must be the looked-up Spotify artist name (never user input).
+    actual_tour_title: setlist playlist name when found; never use user's concert/tour input.
+    """
+    unknown_songs_uris, playlist_title, description = plan_prep_playlist(
+        liked_songs, top_user_tracks, top_artist_tracks, setlist, artist_name, actual_tour_title)
+    if not unknown_songs_uris:
+        return f"No new songs to add! You already know all the songs from {artist_name}'s setlist and top tracks."
+
+    # Reuse the prep playlist from an earlier run for the same tour instead of making a duplicate
+    existing = find_user_playlist(access_token, user_id, playlist_title) if REUSE_PREP_PLAYLISTS else None
+    if existing:
+        return update_prep_playlist(access_token, existing, unknown_songs_uris, progress)
+
     # Use /me/playlists endpoint for better compatibility
-    url = "https://api.spotify.com/v1/me/playlists"
+    url = f"{SPOTIFY_API_BASE}/me/playlists"
     headers = {
         "Authorization": f"Bearer {access_token}",
         "Content-Type": "application/json"
@@ -375,7 +1588,7 @@ def unheard_tracks(user_id, access_token, liked_songs, top_user_tracks, top_arti
         "public": False
     } 
 
-    response = requests.post(url, headers=headers, json=params)
+    response = spotify_post(url, headers=headers, json=params)
     if response.status_code != 201:
         return f"Error creating playlist: {response.status_code}, {response.text}"
 
@@ -383,25 +1596,1048 @@ def unheard_tracks(user_id, access_token, liked_songs, top_user_tracks, top_arti
     playlist_id = data["id"]
     playlist_url = data["external_urls"]["spotify"]
 
-    # Spotify API allows max 100 tracks per request, so we need to batch them
-    playlist_tracks_url = f"https://api.spotify.com/v1/playlists/{playlist_id}/tracks"
-    playlist_headers = {
+    error = add_playlist_tracks(access_token, playlist_id, unknown_songs_uris, 0, progress)
+    if error:
+        return error
+    
+    return f"Successfully created playlist with {len(unknown_songs_uris)} songs! Here's the link: {playlist_url}"
+
+############################## PLAYLIST WRITER ##############################
+
+# Update the user's existing prep playlist for a tour (if they made one before) rather than creating another
+REUSE_PREP_PLAYLISTS = os.getenv("REUSE_PREP_PLAYLISTS", "1") != "0"
+
+def find_user_playlist(access_token, user_id, name):
+    """The playlist called name that user_id owns, as {"id", "url", "snapshot_id"}, or None."""
+    url = f"{SPOTIFY_API_BASE}/me/playlists"
+    headers = {"Authorization": f"Bearer {access_token}"}
+
+    def page(offset):
+        response = spotify_get(url, headers=headers, params={"offset": offset, "limit": 50})
+        if response.status_code == 200:
+            return response.json()
+        print(f"Error fetching user's playlists: {response.status_code}, {response.text}")
+        return None
+
+    return owned_playlist(fetch_all_pages(page, 50, LIKED_SONGS_WORKERS), user_id, name)
+
+def owned_playlist(playlists, user_id, name):
+    """The playlist called name (ignoring case) that user_id owns among /me/playlists items, or None."""
+    for playlist in playlists or ():
+        if (playlist and playlist.get("name", "").strip().lower() == name.strip().lower()
+                and (playlist.get("owner") or {}).get("id") == user_id):
+            return {"id": playlist["id"], "url": playlist["external_urls"]["spotify"], "snapshot_id": playlist.get("snapshot_id")}
+    return None
+
+def playlist_length(access_token, playlist_id):
+    url = f"{SPOTIFY_API_BASE}/playlists/{playlist_id}"
+    headers = {"Authorization": f"Bearer {access_token}"}
+    response = spotify_get(url, headers=headers, params={"fields": "snapshot_id,tracks.total"})
+    if response.status_code == 200:
+        data = response.json()
+        return data["tracks"]["total"], data["snapshot_id"]
+    return None, None
+
+def add_tracks_batch(access_token, playlist_id, uris, position):
+    """
+    Inserts one batch at an explicit position; returns the new snapshot_id, or the failed response.
+    This loop is the only retry policy for the batch (spotify_post doesn't retry here). Failures other
+    than a 429 are only retried after checking the playlist length, since a request that timed out may
+    still have been applied. That way a retry never adds the same batch twice.
+    """
+    url = f"{SPOTIFY_API_BASE}/playlists/{playlist_id}/tracks"
+    headers = {
         "Authorization": f"Bearer {access_token}",
         "Content-Type": "application/json"
     }
-    
-    # Batch tracks in groups of 100
+
+    response = None
+    for attempt in range(SPOTIFY_MAX_RETRIES + 1):
+        try:
+            response = spotify_post(url, headers=headers, json={"uris": uris, "position": position}, max_retries=0)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            print(f"Adding tracks at {position} failed ({e})")
+            response = None
+        if response is not None and response.status_code in (200, 201):
+            return response.json().get("snapshot_id"), None
+
+        check_length, delay = add_batch_retry(response, attempt)
+        if check_length:
+            length, snapshot_id = playlist_length(access_token, playlist_id)
+            if length is not None and length >= position + len(uris):
+                return snapshot_id, None  # it went through after all
+        if delay is None:
+            break
+        time.sleep(delay)
+    return None, response
+
+def add_batch_retry(response, attempt):
+    """
+    What to do after a batch add failed: (check_length, delay). check_length says whether it may have
+    gone through anyway; delay is how long to wait before trying again, or None to give up.
+    """
+    if response is not None and response.status_code not in RETRY_STATUSES:
+        return False, None
+    # spotify never applies a request it answered with 429, so there's nothing to check
+    check_length = response is None or response.status_code != 429
+    delay = retry_delay(response, attempt)
+    return check_length, None if attempt == SPOTIFY_MAX_RETRIES else delay
+
+def add_tracks_error(failed):
+    if failed is None:
+        return "Error adding tracks to playlist: Spotify could not be reached."
+    return f"Error adding tracks to playlist: {failed.status_code}, {failed.text}"
+
+def add_playlist_tracks(access_token, playlist_id, uris, start_position=0, progress=None):
+    """
+    Adds uris in 100-track batches, each at an explicit position so the order is kept whatever gets
+    retried. Batches go one after another: a position is only valid once the batches before it are in.
+    Returns an error message, or None.
+    """
+    # Spotify API allows max 100 tracks per request, so we need to batch them
     batch_size = 100
-    for i in range(0, len(unknown_songs_uris), batch_size):
-        batch_uris = unknown_songs_uris[i:i + batch_size]
-        playlist_params = {"uris": batch_uris}
-        playlist_response = requests.post(playlist_tracks_url, headers=playlist_headers, json=playlist_params)
-        if playlist_response.status_code not in [200, 201]:
-            return f"Error adding tracks to playlist: {playlist_response.status_code}, {playlist_response.text}"
-    
-    return f"Successfully created playlist with {len(unknown_songs_uris)} songs! Here's the link: {playlist_url}"
+    for i in range(0, len(uris), batch_size):
+        batch_uris = uris[i:i + batch_size]
+        snapshot_id, failed = add_tracks_batch(access_token, playlist_id, batch_uris, start_position + i)
+        if snapshot_id is None:
+            return add_tracks_error(failed)
+        if progress:
+            progress("create_playlist", tracks_added=i + len(batch_uris), tracks_total=len(uris))
+    return None
+
+def remove_playlist_tracks(access_token, playlist_id, uris, snapshot_id=None):
+    """Removes every occurrence of uris. Order doesn't matter here, so the 100-track batches are sent concurrently."""
+    url = f"{SPOTIFY_API_BASE}/playlists/{playlist_id}/tracks"
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/json"
+    }
+
+    def remove(batch):
+        body = {"tracks": [{"uri": uri} for uri in batch]}
+        if snapshot_id:
+            body["snapshot_id"] = snapshot_id
+        return spotify_request("DELETE", url, headers=headers, json=body)
+
+    batches = [uris[i:i + 100] for i in range(0, len(uris), 100)]
+    with ContextThreadPoolExecutor(max_workers=max(1, min(SETLIST_DETAIL_WORKERS, len(batches)))) as pool:
+        for response in pool.map(remove, batches):
+            if response.status_code != 200:
+                return f"Error removing tracks from playlist: {response.status_code}, {response.text}"
+    return None
+
+def update_prep_playlist(access_token, playlist, uris, progress=None):
+    """
+    Brings an existing prep playlist in line with uris by diffing: songs the user has learned since
+    are removed, new ones are appended, everything else is left alone.
+    """
+    current = playlist_tracks(access_token, playlist["id"])
+    if current is None:
+        return "Error reading your existing prep playlist."
+
+    wanted = set(uris)
+    current_uris = [track.uri for track in current]
+    to_remove = list(dict.fromkeys(uri for uri in current_uris if uri not in wanted))
+    present = set(current_uris)
+    to_add = [uri for uri in uris if uri not in present]
+
+    if to_remove:
+        error = remove_playlist_tracks(access_token, playlist["id"], to_remove, playlist.get("snapshot_id"))
+        if error:
+            return error
+    kept = sum(1 for uri in current_uris if uri in wanted)
+    error = add_playlist_tracks(access_token, playlist["id"], to_add, kept, progress)
+    if error:
+        return error
+
+    print(f"Updated prep playlist: +{len(to_add)} / -{len(to_remove)} tracks")
+    return f"Successfully updated playlist with {len(uris)} songs! Here's the link: {playlist['url']}"
+
+
+
+############################## PIPELINE ##############################
+
+class StageTimer:
+    """
+    Records when each pipeline stage started (relative to the timer) and how long it took, in ms.
+    progress(stage, status=...) is called as each stage starts and finishes.
+    """
+
+    def __init__(self, progress=None):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.progress = progress
+        metrics = current_metrics.get()
+        if metrics:
+            metrics.timers.append(self)
+
+    def run(self, name, fn, *args, **kwargs):
+        if self.progress:
+            self.progress(name, status="running")
+        started = time.perf_counter()
+        stage_token = current_stage.set(name)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            current_stage.reset(stage_token)
+            ended = time.perf_counter()
+            self.stages[name] = {
+                "start_ms": round((started - self.start) * 1000, 1),
+                "duration_ms": round((ended - started) * 1000, 1),
+            }
+            if self.progress:
+                self.progress(name, status="done")
+
+    async def run_async(self, name, fn, *args, **kwargs):
+        # run() for coroutine functions
+        if self.progress:
+            self.progress(name, status="running")
+        started = time.perf_counter()
+        stage_token = current_stage.set(name)
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            current_stage.reset(stage_token)
+            ended = time.perf_counter()
+            self.stages[name] = {
+                "start_ms": round((started - self.start) * 1000, 1),
+                "duration_ms": round((ended - started) * 1000, 1),
+            }
+            if self.progress:
+                self.progress(name, status="done")
+
+    def total_ms(self):
+        return round((time.perf_counter() - self.start) * 1000, 1)
+
+    def report(self):
+        parts = [f"{name}={t['duration_ms']}ms (+{t['start_ms']})" for name, t in self.stages.items()]
+        print(f"Stage timings: {', '.join(parts)}; total={self.total_ms()}ms")
+
+def resolve_user(access_token, timer, progress=None):
+    """
+    User side: profile, then liked songs. Returns (profile, liked songs, deferred) - deferred means the
+    known-songs strategy needs the candidate songs first, so the liked songs are resolved later.
+    """
+    # the profile comes first: its user id is what the liked songs snapshot is stored under
+    user_prof = timer.run("user_profile", user_profile, access_token)
+    if not user_prof:
+        return None, None, False
+    # with a snapshot the library is only a page or two away, which beats streaming / checking it
+    if KNOWN_SONGS_STRATEGY in ("stream", "contains") and not (LIKED_SONGS_SNAPSHOTS and os.path.exists(snapshot_path(user_prof["id"]))):
+        return user_prof, None, True
+    return user_prof, timer.run("liked_songs", user_liked_songs, access_token, user_id=user_prof["id"], progress=progress), False
+
+def resolve_deferred_known_songs(access_token, candidates, top_user_tracks, timer, progress=None):
+    resolve = check_known_songs if KNOWN_SONGS_STRATEGY == "contains" else stream_known_songs
+    return timer.run("liked_songs", resolve, access_token, candidates, top_user_tracks, progress)
+
+def resolve_artist(access_token, artist_name, concert_name, year, timer, label=""):
+    """
+    Artist chain: artist id, then its top tracks and the setlist at the same time.
+    Returns (actual artist name, top tracks, find_setlist result); label prefixes the stage names.
+    """
+    artist_id = timer.run(f"{label}artist_id", get_artist_id, access_token, artist_name)
+    if not artist_id or not artist_id[0]:
+        return None, None, None
+    actual_artist_name = artist_id[1]  # Use the actual Spotify artist name
+    with ContextThreadPoolExecutor(max_workers=1) as pool:
+        setlist_future = pool.submit(timer.run, f"{label}setlist", find_setlist, access_token, actual_artist_name, concert_name or None, year or None)
+        top_tracks = timer.run(f"{label}artist_top_tracks", artist_top_tracks, access_token, artist_id[0], actual_artist_name)
+        return actual_artist_name, top_tracks, setlist_future.result()
+
+def unpack_setlist(setlist_result):
+    # find_setlist returns (None, None) / (None, None, None) when nothing was found
+    if setlist_result and setlist_result[0] is not None:
+        return setlist_result
+    return None, None, None
+
+def gather_playlist_inputs(access_token, artist_name, concert_name=None, year=None, timer=None, progress=None):
+    """
+    Runs every Spotify fetch needed before unheard_tracks. The user-side fetches (profile -> liked songs,
+    top tracks) and the artist chain (artist id -> top tracks + setlist) all run at the same time, so
+    wall-clock time is roughly the slowest branch instead of the sum.
+    Returns a dict of results, with an "error" message if a required stage failed.
+    """
+    timer = timer or StageTimer(progress)
+
+    with ContextThreadPoolExecutor(max_workers=3) as pool:
+        user_future = pool.submit(resolve_user, access_token, timer, progress)
+        top_future = pool.submit(timer.run, "known_tracks", user_known_tracks, access_token)
+        artist_future = pool.submit(resolve_artist, access_token, artist_name, concert_name, year, timer)
+
+        results = {"top_user_tracks": top_future.result()}
+        results["user_profile"], results["liked_songs"], deferred = user_future.result()
+        results["artist_name"], results["top_artist_tracks"], setlist_result = artist_future.result()
+
+    results["timings"] = timer
+
+    results["setlist_tracks"], results["actual_tour_title"], results["setlist_url"] = unpack_setlist(setlist_result)
+    if progress:
+        progress("setlist", found=results["setlist_tracks"] is not None, title=results["actual_tour_title"])
+
+    liked_ok = bool(results["liked_songs"])
+    results["liked_songs_count"] = len(results["liked_songs"] or [])
+    if deferred:
+        # only worth doing once everything else is in place
+        liked_ok = True
+        if results["top_user_tracks"] and results["top_artist_tracks"]:
+            candidates = results["top_artist_tracks"] + (results["setlist_tracks"] or [])
+            results["liked_songs"], results["liked_songs_count"] = resolve_deferred_known_songs(
+                access_token, candidates, results["top_user_tracks"], timer, progress)
+            liked_ok = results["liked_songs"] is not None and results["liked_songs_count"] > 0
+
+    error = playlist_inputs_error(results, liked_ok, artist_name)
+    if error:
+        results["error"] = error
+    return results
+
+def playlist_inputs_error(results, liked_ok, artist_name):
+    # same checks (and order) as when the stages ran one after another
+    if not results["user_profile"]:
+        return 'Error retrieving user profile.'
+    if not liked_ok:
+        return 'Error retrieving user\'s liked songs.'
+    if not results["top_user_tracks"]:
+        return 'Error retrieving user\'s top tracks.'
+    if not results["artist_name"]:
+        return f'Error retrieving artist\'s ID. Could not find "{artist_name}".'
+    if not results["top_artist_tracks"]:
+        return 'Error retrieving artist\'s top tracks.'
+    return None
+
+def playlist_url_from_result(playlist_result):
+    playlist_url = None
+    # Extract playlist URL from result if it contains one
+    if playlist_result:
+        # Try multiple patterns to extract the URL
+        url_patterns = [
+            r'https://open\.spotify\.com/playlist/[a-zA-Z0-9]+',
+            r'https://open\.spotify\.com/playlist/[^\s]+',
+        ]
+        for pattern in url_patterns:
+            url_match = re.search(pattern, playlist_result)
+            if url_match:
+                playlist_url = url_match.group(0)
+                break
+        
+        # Also try splitting by common phrases
+        if not playlist_url:
+            for phrase in ["Here's the link:", "link:", "Link:"]:
+                if phrase in playlist_result:
+                    try:
+                        potential_url = playlist_result.split(phrase)[1].strip().split()[0]
+                        if potential_url.startswith('http'):
+                            playlist_url = potential_url
+                            break
+                    except:
+                        pass
+    return playlist_url
+
+def finish_prep_playlist(access_token, inputs, timer, progress=None, label=""):
+    """Creates the prep playlist from gathered inputs and returns the result.html context."""
+    user_prof = inputs["user_profile"]
+    liked_songs = inputs["liked_songs"]
+    top_user_tracks = inputs["top_user_tracks"]
+    actual_artist_name = inputs["artist_name"]
+    top_artist_tracks = inputs["top_artist_tracks"]
+    setlist_tracks = inputs["setlist_tracks"]
+    actual_tour_title = inputs["actual_tour_title"]
+
+    playlist_result = ""
+
+    if setlist_tracks is not None:
+        playlist_result = timer.run(f"{label}create_playlist", unheard_tracks, user_prof["id"], access_token, liked_songs, top_user_tracks, top_artist_tracks, setlist_tracks, actual_artist_name, actual_tour_title=actual_tour_title, progress=progress)
+        print(playlist_result)
+    else:
+        # No setlist: use only looked-up artist name, no tour title (never user input)
+        playlist_result = timer.run(f"{label}create_playlist", unheard_tracks, user_prof["id"], access_token, liked_songs, top_user_tracks, top_artist_tracks, [], actual_artist_name, progress=progress)
+        print(playlist_result)
+
+    return prep_playlist_context(inputs, playlist_result)
+
+def prep_playlist_context(inputs, playlist_result):
+    """result.html context for gathered inputs + unheard_tracks' message."""
+    actual_artist_name = inputs["artist_name"]
+    setlist_tracks = inputs["setlist_tracks"]
+    actual_tour_title = inputs["actual_tour_title"]
+    playlist_url = playlist_url_from_result(playlist_result)
+
+    # Only use looked-up values for display; never user input
+    display_artist_name = actual_artist_name
+    display_tour = actual_tour_title if actual_tour_title else "No setlist found"
+
+    return dict(
+        artist_name=display_artist_name,
+        tour_name=display_tour,
+        liked_songs_count=inputs["liked_songs_count"],
+        user_top_tracks_count=len(inputs["top_user_tracks"]),
+        artist_top_tracks_count=len(inputs["top_artist_tracks"]),
+        setlist_found=setlist_tracks is not None,
+        setlist_tracks_count=len(setlist_tracks) if setlist_tracks else 0,
+        playlist_result=playlist_result,
+        playlist_url=playlist_url,
+        setlist_url=inputs["setlist_url"]
+    )
+
+def build_prep_playlist(access_token, artist_name, concert_name=None, year=None, progress=None):
+    """
+    The whole flow after login: gathers everything, creates the prep playlist and returns the
+    result.html context (just {"error": ...} if something failed).
+    """
+    inputs = gather_playlist_inputs(access_token, artist_name, concert_name, year, progress=progress)
+    timer = inputs["timings"]
+    if inputs.get("error"):
+        timer.report()
+        return {"error": inputs["error"]}
+
+    context = finish_prep_playlist(access_token, inputs, timer, progress)
+    timer.report()
+    return context
+
+############################## BATCH MODE ##############################
+
+# Max number of shows whose artist/setlist are looked up (and playlists written) at once
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", "4"))
+
+def parse_show_info(info):
+    """"artist/concert/year" (same format as ?info=) -> (artist, concert, year), or None if a part is missing."""
+    parts = [p.strip() for p in info.split("/")]
+    if len(parts) >= 3 and parts[0] and parts[1] and parts[2]:
+        return parts[0], parts[1], parts[2]
+    return None
+
+def build_prep_playlists(access_token, shows, progress=None):
+    """
+    Prep playlists for a whole concert calendar in one go. shows is a list of (artist, concert, year).
+    The user's songs are fetched once and shared; every show's artist + setlist is looked up at the
+    same time. Returns {"shows": [result.html context per show], "summary": "..."}, or {"error": ...}
+    if the user's side failed.
+    """
+    timer = StageTimer(progress)
+    labels = [f"{i + 1}. {artist}: " for i, (artist, concert, year) in enumerate(shows)]
+
+    with ContextThreadPoolExecutor(max_workers=2 + BATCH_WORKERS) as pool:
+        user_future = pool.submit(resolve_user, access_token, timer, progress)
+        top_future = pool.submit(timer.run, "known_tracks", user_known_tracks, access_token)
+        with ContextThreadPoolExecutor(max_workers=BATCH_WORKERS) as artist_pool:
+            artist_futures = [artist_pool.submit(resolve_artist, access_token, artist, concert, year, timer, label)
+                              for (artist, concert, year), label in zip(shows, labels)]
+            artists = [future.result() for future in artist_futures]
+        top_user_tracks = top_future.result()
+        user_prof, liked_songs, deferred = user_future.result()
+
+    liked_songs_count = len(liked_songs or [])
+    if user_prof and top_user_tracks and deferred:
+        # one pass over the candidates of every show
+        candidates = []
+        for actual_artist_name, top_artist_tracks, setlist_result in artists:
+            candidates += (top_artist_tracks or []) + (unpack_setlist(setlist_result)[0] or [])
+        liked_songs, liked_songs_count = resolve_deferred_known_songs(access_token, candidates, top_user_tracks, timer, progress)
+
+    error = None
+    if not user_prof:
+        error = 'Error retrieving user profile.'
+    elif liked_songs is None or not liked_songs_count:
+        error = 'Error retrieving user\'s liked songs.'
+    elif not top_user_tracks:
+        error = 'Error retrieving user\'s top tracks.'
+    if error:
+        timer.report()
+        return {"error": error}
+
+    def finish(show, label, artist):
+        actual_artist_name, top_artist_tracks, setlist_result = artist
+        if not actual_artist_name:
+            return {"error": f'Error retrieving artist\'s ID. Could not find "{show[0]}".'}
+        if not top_artist_tracks:
+            return {"error": f'Error retrieving {actual_artist_name}\'s top tracks.'}
+        setlist_tracks, actual_tour_title, setlist_url = unpack_setlist(setlist_result)
+        inputs = {
+            "user_profile": user_prof,
+            "liked_songs": liked_songs,
+            "liked_songs_count": liked_songs_count,
+            "top_user_tracks": top_user_tracks,
+            "artist_name": actual_artist_name,
+            "top_artist_tracks": top_artist_tracks,
+            "setlist_tracks": setlist_tracks,
+            "actual_tour_title": actual_tour_title,
+            "setlist_url": setlist_url,
+        }
+        return finish_prep_playlist(access_token, inputs, timer, progress, label)
+
+    # Two dates of the same tour get the same prep playlist title. Those go one after another, so the
+    # later one finds (and updates) the playlist the first one made instead of both creating one
+    groups = {}
+    for i, (actual_artist_name, top_artist_tracks, setlist_result) in enumerate(artists):
+        key = i
+        if actual_artist_name:
+            key = prep_playlist_title(actual_artist_name, unpack_setlist(setlist_result)[1]).strip().lower()
+        groups.setdefault(key, []).append(i)
+
+    def finish_group(indexes):
+        return [(i, finish(shows[i], labels[i], artists[i])) for i in indexes]
+
+    results = [None] * len(shows)
+    with ContextThreadPoolExecutor(max_workers=BATCH_WORKERS) as pool:
+        for finished in pool.map(finish_group, groups.values()):
+            for i, result in finished:
+                results[i] = result
+    timer.report()
+
+    created = [r for r in results if r.get("playlist_url")]
+    new_songs = sum(int(m.group(1)) for r in created for m in [re.search(r'with (\d+) songs', r["playlist_result"])] if m)
+    summary = f"Made {len(created)} of {len(shows)} prep playlists with {new_songs} songs in total."
+    print(summary)
+    return {"shows": results, "summary": summary}
+
+############################## ASYNC CLIENT ##############################
+
+# asyncio version of the pipeline on httpx (optional: pip install httpx, plus asgiref for the async
+# Flask route). Fan-out is a coroutine per request instead of a thread, so one event loop can run many
+# users' pipelines at once - build_prep_playlist_async can be awaited from any asyncio server or script.
+# /process-async serves it through Flask; the sync functions above stay the default everywhere else.
+# Same caches, snapshots, retries and instrumentation as the sync path. Known songs always use the
+# "library" strategy here.
+httpx = lazy_import("httpx")
+
+def async_client_available():
+    return importlib.util.find_spec("httpx") is not None
+
+def make_async_client():
+    # one client per pipeline run: an httpx client belongs to the event loop it was made on
+    limits = httpx.Limits(max_connections=32, max_keepalive_connections=32)
+    return httpx.AsyncClient(timeout=SPOTIFY_TIMEOUT, limits=limits)
+
+async def spotify_request_async(client, method, url, max_retries=None, **kwargs):
+    """spotify_request for an httpx.AsyncClient: same retries, backoff and metrics, but sleeps without blocking."""
+    max_retries = SPOTIFY_MAX_RETRIES if max_retries is None else max_retries
+    retry_statuses = RETRY_STATUSES if method in IDEMPOTENT_METHODS else {429}
+    metrics = current_metrics.get()
+    started = time.perf_counter()
+    rate_limited = 0
+
+    for attempt in range(max_retries + 1):
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.TransportError as e:
+            if attempt == max_retries or method not in IDEMPOTENT_METHODS:
+                if metrics:
+                    metrics.record(method, url, None, attempt, rate_limited, time.perf_counter() - started)
+                raise
+            print(f"{method} {url} failed ({e}), retrying")
+            await asyncio.sleep(retry_delay(None, attempt))
+            continue
+
+        if response.status_code == 429:
+            rate_limited += 1
+        delay = retry_delay(response, attempt) if response.status_code in retry_statuses else None
+        if delay is None or attempt == max_retries:
+            if metrics:
+                metrics.record(method, url, response, attempt, rate_limited, time.perf_counter() - started)
+            return response
+        print(f"{method} {url} returned {response.status_code}, retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+async def spotify_get_async(client, access_token, url, **kwargs):
+    headers = {"Authorization": f"Bearer {access_token}"}
+    return await spotify_request_async(client, "GET", url, headers=headers, **kwargs)
+
+async def fetch_all_pages_async(fetch_page, page_size, workers, on_page=None):
+    """fetch_all_pages for a coroutine fetch_page: the first page, then every other one at once (workers at a time)."""
+    first_page = await fetch_page(0)
+    if first_page is None:
+        return None
+
+    items = first_page["items"]
+    total = first_page.get("total", 0)
+    fetched = [len(items)]
+    if on_page:
+        on_page(fetched[0], total)
+
+    async def fetch(offset):
+        page = await fetch_page(offset)
+        if page is not None and on_page:
+            fetched[0] += len(page["items"])
+            on_page(fetched[0], total)
+        return page
+
+    for page in await gather_limited(workers, [fetch(offset) for offset in range(page_size, total, page_size)]):
+        if page is None:
+            return None
+        items.extend(page["items"])
+    return items
+
+async def gather_limited(limit, coroutines):
+    """asyncio.gather with at most limit coroutines awaiting at once; results keep their order."""
+    semaphore = asyncio.Semaphore(max(1, limit))
+
+    async def run(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*(run(coroutine) for coroutine in coroutines))
 
+def cached_across_users_async(namespace, key_args, sync_fn):
+    """
+    cached_across_users for coroutine functions, sharing sync_fn's entries (same namespace + key).
+    Stale entries are refreshed in a background thread with sync_fn, like on the sync path.
+    """
+    def decorator(fn):
+        async def wrapper(*args, **kwargs):
+            bound = dict(zip(fn.__code__.co_varnames, args), **kwargs)
+            key = "|".join([namespace] + [normalize_key_part(bound.get(arg)) for arg in key_args])
+            sync_kwargs = {name: value for name, value in bound.items() if name != "client"}
+            # the backend may be sqlite: kept off the event loop
+            found, value = await asyncio.to_thread(shared_cache.lookup, namespace, key, lambda: sync_fn.uncached(**sync_kwargs))
+            if found:
+                return value
+            return await asyncio.to_thread(shared_cache.store, key, await fn(*args, **kwargs))
+        wrapper.__name__ = fn.__name__
+        wrapper.__doc__ = fn.__doc__
+        wrapper.uncached = fn
+        return wrapper
+    return decorator
+
+async def user_profile_async(client, access_token):
+    response = await spotify_get_async(client, access_token, f"{SPOTIFY_API_BASE}/me")
+    if response.status_code == 200:
+        return response.json()
+    print(f"Error fetching user profile: {response.status_code}, {response.text}")
+    return None
+
+async def user_top_tracks_async(client, access_token, time_range="medium_term"):
+    response = await spotify_get_async(client, access_token, f"{SPOTIFY_API_BASE}/me/top/tracks",
+                                       params={"time_range": time_range, "limit": 50})
+    if response.status_code == 200:
+        return parse_tracks(response.json()["items"])
+    print(f"Error fetching user's top tracks ({time_range}): {response.status_code}, {response.text}")
+    return None
+
+async def recently_played_tracks_async(client, access_token):
+    response = await spotify_get_async(client, access_token, f"{SPOTIFY_API_BASE}/me/player/recently-played", params={"limit": 50})
+    if response.status_code == 200:
+        return parse_tracks(item.get("track") for item in response.json().get("items", []))
+    print(f"Error fetching user's recently played tracks: {response.status_code}, {response.text}")
+    return None
 
+async def saved_album_tracks_async(client, access_token):
+    url = f"{SPOTIFY_API_BASE}/me/albums"
+
+    async def page(offset):
+        response = await spotify_get_async(client, access_token, url, params={"offset": offset, "limit": 50})
+        if response.status_code == 200:
+            data = response.json()
+            data["items"] = saved_album_page_tracks(data)
+            return data
+        print(f"Error fetching user's saved albums (offset {offset}): {response.status_code}, {response.text}")
+        return None
+
+    return await fetch_all_pages_async(page, 50, LIKED_SONGS_WORKERS)
+
+async def user_known_tracks_async(client, access_token):
+    """user_known_tracks: every source at once, merged the same way."""
+    ranges = TOP_TRACK_RANGES if "top" in KNOWN_SONG_SOURCES else ("medium_term",)
+    fetches = {time_range: user_top_tracks_async(client, access_token, time_range) for time_range in ranges}
+    if "recent" in KNOWN_SONG_SOURCES:
+        fetches["recent"] = recently_played_tracks_async(client, access_token)
+    if "albums" in KNOWN_SONG_SOURCES:
+        fetches["albums"] = saved_album_tracks_async(client, access_token)
+    results = await asyncio.gather(*fetches.values())
+    return merge_known_tracks(dict(zip(fetches, results)))
+
+async def liked_songs_page_async(client, access_token, offset, limit=50):
+    response = await spotify_get_async(client, access_token, f"{SPOTIFY_API_BASE}/me/tracks",
+                                       params={"offset": offset, "limit": limit})
+    if response.status_code == 200:
+        data = response.json()
+        data["items"] = page_items(data)
+        return data
+    print(f"Error fetching user's liked tracks (offset {offset}): {response.status_code}, {response.text}")
+    return None
+
+async def liked_song_items_async(client, access_token, progress=None):
+    page_size = 50
+    return await fetch_all_pages_async(lambda offset: liked_songs_page_async(client, access_token, offset, page_size),
+                                       page_size, LIKED_SONGS_WORKERS, liked_songs_progress(progress))
+
+async def sync_liked_songs_snapshot_async(client, access_token, user_id, progress=None):
+    """
+    sync_liked_songs_snapshot: only the songs liked since the snapshot are downloaded. Reading and
+    writing the snapshot (JSON, megabytes for a big library) happens in a thread, off the event loop.
+    """
+    snapshot = await asyncio.to_thread(load_liked_snapshot, user_id)
+    if not snapshot:
+        items = await liked_song_items_async(client, access_token, progress)
+        return None if items is None else await asyncio.to_thread(save_liked_snapshot, user_id, items)
+
+    known = snapshot_keys(snapshot)
+    new_items = []
+    page_size = 50
+    offset = 0
+    while True:
+        page = await liked_songs_page_async(client, access_token, offset, page_size)
+        if page is None:
+            return None
+        offset += page_size
+        if not new_liked_items(known, page, new_items, offset):
+            break
+
+    merged = await asyncio.to_thread(merge_liked_snapshot, user_id, snapshot, new_items, page.get("total"), progress)
+    if merged is None:
+        items = await liked_song_items_async(client, access_token, progress)
+        return None if items is None else await asyncio.to_thread(save_liked_snapshot, user_id, items)
+    return merged
+
+async def user_liked_songs_async(client, access_token, user_id=None, progress=None):
+    if user_id and LIKED_SONGS_SNAPSHOTS:
+        items = await sync_liked_songs_snapshot_async(client, access_token, user_id, progress)
+    else:
+        items = await liked_song_items_async(client, access_token, progress)
+    if items is None:
+        return None
+    return [track for added_at, track in items]
+
+@cached_across_users_async("artist_id", ["artist_name"], get_artist_id)
+async def get_artist_id_async(client, access_token, artist_name):
+    response = await spotify_get_async(client, access_token, f"{SPOTIFY_API_BASE}/search",
+                                       params={"q": artist_name, "type": "artist", "limit": 50})
+    if response.status_code != 200:
+        print(f"Error searching for artist: {response.status_code}, {response.text}")
+        return None, None
+    artists = response.json()["artists"]["items"]
+    for artist in artists:
+        if artist_name.strip().lower() == artist["name"].strip().lower():
+            return artist["id"], artist["name"]
+    if not artists:
+        print(f"No artist found for '{artist_name}'")
+        return None, None
+    print(f"Warning: No exact match found for '{artist_name}', showing first result.")
+    return artists[0]["id"], artists[0]["name"]
+
+@cached_across_users_async("artist_top_tracks", ["artist_id"], artist_top_tracks)
+async def artist_top_tracks_async(client, access_token, artist_id, artist_name):
+    response = await spotify_get_async(client, access_token, f"{SPOTIFY_API_BASE}/artists/{artist_id}/top-tracks",
+                                       params={"market": "US"})
+    if response.status_code == 200:
+        return parse_tracks(response.json()["tracks"])
+    print(f"Error fetching {artist_name}'s top tracks: {response.status_code}, {response.text}")
+    return None
+
+async def playlist_tracks_page_async(client, access_token, playlist_id, offset, limit=100):
+    params = {"offset": offset, "limit": limit, "fields": PLAYLIST_TRACK_FIELDS}
+    response = await spotify_get_async(client, access_token, f"{SPOTIFY_API_BASE}/playlists/{playlist_id}/tracks", params=params)
+    if response.status_code == 200:
+        data = response.json()
+        data["items"] = parse_tracks(item.get("track") for item in data.get("items", []))
+        return data
+    print(f"Error fetching playlist tracks (offset {offset}): {response.status_code}, {response.text}")
+    return None
+
+async def playlist_tracks_async(client, access_token, playlist_id):
+    page_size = 100
+    return await fetch_all_pages_async(lambda offset: playlist_tracks_page_async(client, access_token, playlist_id, offset, page_size),
+                                       page_size, SETLIST_DETAIL_WORKERS)
+
+async def setlist_details_async(client, access_token, playlist_id):
+    response = await spotify_get_async(client, access_token, f"{SPOTIFY_API_BASE}/playlists/{playlist_id}",
+                                       params={"fields": "followers.total,name,external_urls"})
+    if response.status_code != 200:
+        print(f"Error fetching playlist {playlist_id}: {response.status_code}, {response.text}")
+        return None
+    details = response.json()
+    return {
+        "name": details['name'],
+        "followers": (details.get('followers') or {}).get('total', 0),
+        "url": details['external_urls']['spotify'],
+        "id": playlist_id,
+    }
+
+async def pick_setlist_async(client, access_token, ranked):
+    """pick_setlist: details in rank order, a batch at a time, until nothing left can win."""
+    picker = SetlistPicker(ranked)
+    only = picker.only_candidate()
+    if only:
+        return only
+
+    for batch in picker.batches():
+        picker.add(batch, await asyncio.gather(*(setlist_details_async(client, access_token, playlist['id']) for score, playlist in batch)))
+    return picker.best
+
+@cached_across_users_async("setlist", ["artist_name", "concert_name", "year"], find_setlist)
+async def find_setlist_async(client, access_token, artist_name, concert_name=None, year=None):
+    """find_setlist: (tracks, playlist name, playlist url), or Nones when there is no setlist."""
+    most_followed_playlist = None
+    playlist_id = await asyncio.to_thread(remembered_setlist_id, artist_name, concert_name, year)
+    if playlist_id:
+        most_followed_playlist = await setlist_details_async(client, access_token, playlist_id)
+
+    if most_followed_playlist is None:
+        query = " ".join([artist_name] + ([concert_name] if concert_name else []) + ["Setlist"] + ([year] if year else []))
+        response = await spotify_get_async(client, access_token, f"{SPOTIFY_API_BASE}/search",
+                                           params={"q": query, "type": "playlist", "limit": 50})
+        if response.status_code != 200:
+            print(f"Error: {response.status_code}, {response.text}")
+            return None, None, None
+
+        playlists = response.json().get('playlists', {}).get('items', [])
+        ranked = rank_setlist_candidates(playlists, artist_name, concert_name, year)
+        if not ranked:
+            print("No playlists match the criteria.")
+            return None, None
+
+        most_followed_playlist = await pick_setlist_async(client, access_token, ranked)
+        if not most_followed_playlist:
+            print("No playlists found.")
+            return None, None, None
+        await asyncio.to_thread(remember_setlist_id, artist_name, concert_name, year, most_followed_playlist["id"])
+
+    print(f"Most followed playlist: {most_followed_playlist['name']}")
+    tracks = await playlist_tracks_async(client, access_token, most_followed_playlist['id'])
+    if tracks is None:
+        return None, None, None
+    return tracks, most_followed_playlist["name"], most_followed_playlist["url"]
+
+async def find_user_playlist_async(client, access_token, user_id, name):
+    url = f"{SPOTIFY_API_BASE}/me/playlists"
+
+    async def page(offset):
+        response = await spotify_get_async(client, access_token, url, params={"offset": offset, "limit": 50})
+        if response.status_code == 200:
+            return response.json()
+        print(f"Error fetching user's playlists: {response.status_code}, {response.text}")
+        return None
+
+    return owned_playlist(await fetch_all_pages_async(page, 50, LIKED_SONGS_WORKERS), user_id, name)
+
+async def playlist_length_async(client, access_token, playlist_id):
+    response = await spotify_get_async(client, access_token, f"{SPOTIFY_API_BASE}/playlists/{playlist_id}",
+                                       params={"fields": "snapshot_id,tracks.total"})
+    if response.status_code == 200:
+        data = response.json()
+        return data["tracks"]["total"], data["snapshot_id"]
+    return None, None
+
+async def add_tracks_batch_async(client, access_token, playlist_id, uris, position):
+    """add_tracks_batch: (new snapshot_id, None), or (None, the failed response), with the same retry rules."""
+    url = f"{SPOTIFY_API_BASE}/playlists/{playlist_id}/tracks"
+    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
+
+    response = None
+    for attempt in range(SPOTIFY_MAX_RETRIES + 1):
+        try:
+            response = await spotify_request_async(client, "POST", url, max_retries=0, headers=headers,
+                                                   json={"uris": uris, "position": position})
+        except httpx.TransportError as e:
+            print(f"Adding tracks at {position} failed ({e})")
+            response = None
+        if response is not None and response.status_code in (200, 201):
+            return response.json().get("snapshot_id"), None
+
+        check_length, delay = add_batch_retry(response, attempt)
+        if check_length:
+            length, snapshot_id = await playlist_length_async(client, access_token, playlist_id)
+            if length is not None and length >= position + len(uris):
+                return snapshot_id, None  # it went through after all
+        if delay is None:
+            break
+        await asyncio.sleep(delay)
+    return None, response
+
+async def add_playlist_tracks_async(client, access_token, playlist_id, uris, progress=None):
+    """add_playlist_tracks: positioned 100-track batches, one after another."""
+    for i in range(0, len(uris), 100):
+        batch = uris[i:i + 100]
+        snapshot_id, failed = await add_tracks_batch_async(client, access_token, playlist_id, batch, i)
+        if snapshot_id is None:
+            return add_tracks_error(failed)
+        if progress:
+            progress("create_playlist", tracks_added=i + len(batch), tracks_total=len(uris))
+    return None
+
+async def unheard_tracks_async(client, user_id, access_token, liked_songs, top_user_tracks, top_artist_tracks, setlist, artist_name, actual_tour_title=None, progress=None):
+    """unheard_tracks: same songs, title and messages; updating an existing prep playlist runs the sync diff in a thread."""
+    uris, playlist_title, description = plan_prep_playlist(
+        liked_songs, top_user_tracks, top_artist_tracks, setlist, artist_name, actual_tour_title)
+    if not uris:
+        return f"No new songs to add! You already know all the songs from {artist_name}'s setlist and top tracks."
+
+    existing = await find_user_playlist_async(client, access_token, user_id, playlist_title) if REUSE_PREP_PLAYLISTS else None
+    if existing:
+        return await asyncio.to_thread(update_prep_playlist, access_token, existing, uris, progress)
+
+    response = await spotify_request_async(client, "POST", f"{SPOTIFY_API_BASE}/me/playlists",
+                                           headers={"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"},
+                                           json={"name": playlist_title, "description": description, "public": False})
+    if response.status_code != 201:
+        return f"Error creating playlist: {response.status_code}, {response.text}"
+    data = response.json()
+
+    error = await add_playlist_tracks_async(client, access_token, data["id"], uris, progress)
+    if error:
+        return error
+    return f"Successfully created playlist with {len(uris)} songs! Here's the link: {data['external_urls']['spotify']}"
+
+async def build_prep_playlist_async(access_token, artist_name, concert_name=None, year=None, progress=None):
+    """build_prep_playlist on asyncio: returns the same result.html context (or {"error": ...})."""
+    if not async_client_available():
+        return {"error": "The async client needs httpx (pip install httpx)."}
+    timer = StageTimer(progress)
+
+    async with make_async_client() as client:
+        async def user_side():
+            # profile first: the liked songs snapshot is stored under its id
+            user_prof = await timer.run_async("user_profile", user_profile_async, client, access_token)
+            if not user_prof:
+                return None, None
+            liked = await timer.run_async("liked_songs", user_liked_songs_async, client, access_token,
+                                          user_id=user_prof["id"], progress=progress)
+            return user_prof, liked
+
+        async def artist_side():
+            artist_id = await timer.run_async("artist_id", get_artist_id_async, client, access_token, artist_name)
+            if not artist_id or not artist_id[0]:
+                return None, None, None
+            actual_artist_name = artist_id[1]
+            top_tracks, setlist_result = await asyncio.gather(
+                timer.run_async("artist_top_tracks", artist_top_tracks_async, client, access_token, artist_id[0], actual_artist_name),
+                timer.run_async("setlist", find_setlist_async, client, access_token, actual_artist_name, concert_name or None, year or None))
+            return actual_artist_name, top_tracks, setlist_result
+
+        (user_prof, liked_songs), top_user_tracks, (actual_artist_name, top_artist_tracks, setlist_result) = await asyncio.gather(
+            user_side(), timer.run_async("known_tracks", user_known_tracks_async, client, access_token), artist_side())
+
+        inputs = {
+            "user_profile": user_prof,
+            "liked_songs": liked_songs,
+            "liked_songs_count": len(liked_songs or []),
+            "top_user_tracks": top_user_tracks,
+            "artist_name": actual_artist_name,
+            "top_artist_tracks": top_artist_tracks,
+        }
+        inputs["setlist_tracks"], inputs["actual_tour_title"], inputs["setlist_url"] = unpack_setlist(setlist_result)
+        if progress:
+            progress("setlist", found=inputs["setlist_tracks"] is not None, title=inputs["actual_tour_title"])
+
+        error = playlist_inputs_error(inputs, bool(liked_songs), artist_name)
+        if error:
+            timer.report()
+            return {"error": error}
+
+        playlist_result = await timer.run_async(
+            "create_playlist", unheard_tracks_async, client, user_prof["id"], access_token, liked_songs, top_user_tracks,
+            top_artist_tracks, inputs["setlist_tracks"] or [], actual_artist_name,
+            actual_tour_title=inputs["actual_tour_title"], progress=progress)
+        print(playlist_result)
+
+    timer.report()
+    return prep_playlist_context(inputs, playlist_result)
+
+############################## BACKGROUND JOBS ##############################
+
+# Playlists can also be built by a worker thread while the loading page polls for progress,
+# instead of holding one HTTP request open for the whole flow. Job state lives in the same kind
+# of store as the shared cache: "memory" (this process only) or "sqlite" (every process on the box)
+JOB_BACKEND = os.getenv("JOB_BACKEND", "memory")
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", os.path.join(tempfile.gettempdir(), "soundcheck-jobs.sqlite3"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+# The job store never drops a job on its own (unlike the LRU caches it's built on). Finished jobs are
+# deleted once there are more than this many, oldest first, so a queued or running job is never lost
+JOB_MAX_FINISHED = int(os.getenv("JOB_MAX_FINISHED", "1024"))
+# Jobs need a process that keeps running after it has answered, and a store every instance can read. Neither
+# holds on Vercel (the function is frozen once the 202 is sent, and polls can land on another instance), so the
+# loading page only starts a job when USE_JOBS=1, or by default with a shared JOB_BACKEND off Vercel.
+# Otherwise it goes straight to /process like before
+USE_JOBS = os.getenv("USE_JOBS", "1" if JOB_BACKEND != "memory" and os.getenv("VERCEL") is None else "0") == "1"
+
+class JobQueue:
+    """Runs build_prep_playlist on a pool of worker threads and keeps each job's status + progress."""
+
+    def __init__(self, store, workers=JOB_WORKERS, max_finished=JOB_MAX_FINISHED):
+        self.store = store
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self.lock = threading.Lock()
+        self.max_finished = max_finished
+        self.finished = deque()
+
+    def get(self, job_id):
+        entry = self.store.get(job_id)
+        return entry[0] if entry else None
+
+    def update(self, job_id, **fields):
+        with self.lock:
+            job = self.get(job_id) or {"id": job_id, "status": "queued", "stages": {}, "result": None, "error": None}
+            job.update(fields)
+            self.store.set(job_id, job, time.time())
+            if job["status"] in ("done", "error"):
+                self.forget_finished(job_id)
+
+    def forget_finished(self, job_id):
+        # only finished jobs are ever deleted, oldest first
+        self.finished.append(job_id)
+        while len(self.finished) > self.max_finished:
+            self.store.delete(self.finished.popleft())
+
+    def progress(self, job_id, stage, **details):
+        with self.lock:
+            job = self.get(job_id)
+            if job is None:  # deleted from under us (e.g. a shared store was cleared): nothing to report to
+                return
+            job.setdefault("stages", {}).setdefault(stage, {}).update(details)
+            self.store.set(job_id, job, time.time())
+
+    def fail(self, error):
+        # a job that failed before it could start, so the loading page still gets a job to show
+        job_id = uuid.uuid4().hex
+        self.update(job_id, status="error", result={"error": error}, error=error)
+        return job_id
+
+    def enqueue(self, access_token, artist_name, concert_name=None, year=None):
+        job_id = uuid.uuid4().hex
+        self.update(job_id, status="queued")
+        self.pool.submit(self.run, job_id, access_token, artist_name, concert_name, year)
+        return job_id
+
+    def run(self, job_id, access_token, artist_name, concert_name, year):
+        self.update(job_id, status="running")
+        with instrumented("job", job_id=job_id) as metrics:
+            try:
+                context = build_prep_playlist(access_token, artist_name, concert_name, year,
+                                              progress=lambda stage, **details: self.progress(job_id, stage, **details))
+            except Exception as e:
+                print(f"Job {job_id} failed: {e}")
+                context = {"error": "Something went wrong while creating your playlist. Please try again."}
+            server_timing = metrics.server_timing()
+        if context.get("error"):
+            self.update(job_id, status="error", error=context["error"], result=context, server_timing=server_timing)
+        else:
+            self.update(job_id, status="done", result=context, server_timing=server_timing)
+
+def make_job_store():
+    # no size limit of its own: JobQueue deletes finished jobs itself
+    if JOB_BACKEND == "sqlite":
+        return SQLiteCache(JOB_DB_PATH, max_entries=sys.maxsize)
+    return MemoryCache(max_entries=sys.maxsize)
+
+job_queue = JobQueue(make_job_store())
+
+
+
+# cProfile a single request: PROFILE_REQUESTS=1 and ?profile=1
+@app.before_request
+def start_profiler():
+    if PROFILE_REQUESTS and request.args.get('profile') == '1':
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+@app.after_request
+def stop_profiler(response):
+    profiler = g.pop('profiler', None)
+    if profiler:
+        profiler.disable()
+        path = os.path.join(PROFILE_DIR, f"soundcheck-{request.endpoint}-{int(time.time() * 1000)}.prof")
+        profiler.dump_stats(path)
+        logger.info(json.dumps({"event": "profile", "endpoint": request.endpoint, "path": path}))
+    return response
 
 # Route to handle logging in
 @app.route('/', methods=['GET', 'POST'])
@@ -426,6 +2662,9 @@ def login():
         session['concert_name'] = concert_name
         session['year'] = year
 
+        # Returning user with a stored token: straight to the loading page, no OAuth round-trip
+        if stored_access_token():
+            return redirect(url_for('redirect_page'))
         auth_url = get_authorization_url()
         return redirect(auth_url)
     else:
@@ -433,11 +2672,11 @@ def login():
         info = request.args.get("info", "")
         if info:
             # Backward compatibility: ?info=artist/concert/year
-            parts = [p.strip() for p in info.split("/")]
-            if len(parts) >= 3 and parts[0] and parts[1] and parts[2]:
-                session['artist_name'] = parts[0]
-                session['concert_name'] = parts[1]
-                session['year'] = parts[2]
+            show = parse_show_info(info)
+            if show:
+                session['artist_name'], session['concert_name'], session['year'] = show
+                if stored_access_token():
+                    return redirect(url_for('redirect_page'))
                 auth_url = get_authorization_url()
                 return redirect(auth_url)
             else:
@@ -448,41 +2687,109 @@ def login():
 
 
     
+# Shared cache hit/miss counters
+@app.route('/cache/stats')
+@app.route('/api/cache/stats')
+def cache_stats():
+    return jsonify(backend=CACHE_BACKEND, stats=shared_cache.stats)
+
 # Route to handle the redirect URI after user authorizes - shows loading page
 @app.route('/redirect')
 @app.route('/api/redirect')
 def redirect_page():
-    authorization_code = request.args.get('code')
-    if not authorization_code:
+    authorization_code = authorization_code_arg()
+    if not authorization_code and not session.get('token_key'):
         return render_template('result.html', error='Authorization code missing. Please try again.')
     
-    # Show loading page, which will redirect to /process
-    return render_template('loading.html', code=authorization_code)
+    # Show loading page, which will redirect to /process (or start a job and poll it)
+    return render_template('loading.html', code=authorization_code or '', use_jobs=USE_JOBS)
+
+# Route to start creating the playlist in the background - the loading page posts here, then polls the job
+@app.route('/jobs', methods=['POST'])
+@app.route('/api/jobs', methods=['POST'])
+def start_job():
+    authorization_code = authorization_code_arg()
+    if not authorization_code and not session.get('token_key'):
+        job_id = job_queue.fail('Authorization code missing. Please try again.')
+    else:
+        access_token = request_access_token(authorization_code)
+        artist_name = session.get('artist_name')
+        if not access_token and not authorization_code:
+            job_id = job_queue.fail('Your Spotify login has expired. Please start over.')
+        elif not access_token:
+            job_id = job_queue.fail('Error retrieving access token. Please check your CLIENT_SECRET in the .env file.')
+        elif not artist_name:
+            job_id = job_queue.fail('Session expired. Please start over and enter an artist name.')
+        else:
+            job_id = job_queue.enqueue(access_token, artist_name, session.get('concert_name') or '', session.get('year') or '')
+    return jsonify(job_id=job_id), 202
+
+# Route the loading page polls for a job's progress
+@app.route('/jobs/<job_id>')
+@app.route('/api/jobs/<job_id>')
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify(error='Job not found.'), 404
+    return jsonify(id=job.get("id", job_id), status=job.get("status"), stages=job.get("stages") or {}, error=job.get("error"))
+
+# Route to show a finished job's result
+@app.route('/jobs/<job_id>/result')
+@app.route('/api/jobs/<job_id>/result')
+def job_result(job_id):
+    job = job_queue.get(job_id)
+    if not job:
+        return render_template('result.html', error='We lost track of your playlist. Please start over.')
+    if job.get("status") not in ("done", "error"):
+        return render_template('loading.html', job_id=job_id)
+    response = make_response(render_template('result.html', **(job.get("result") or {"error": job.get("error")})))
+    if SERVER_TIMING and job.get("server_timing"):
+        response.headers['Server-Timing'] = job["server_timing"]
+    return response
+
+# Batch API: prep playlists for several shows at once. Body: {"shows": ["artist/concert/year", ...]}
+# (or objects with artist_name / concert_name / year), with a Spotify access token as "Authorization: Bearer ..."
+# or a logged-in session
+@app.route('/batch', methods=['POST'])
+@app.route('/api/batch', methods=['POST'])
+def batch_playlists():
+    auth = request.headers.get('Authorization', '')
+    access_token = auth[len('Bearer '):].strip() if auth.startswith('Bearer ') else stored_access_token()
+    if not access_token:
+        return jsonify(error='A Spotify access token is required (Authorization: Bearer ...).'), 401
+
+    shows = []
+    for entry in (request.get_json(silent=True) or {}).get('shows') or []:
+        if isinstance(entry, dict):
+            entry = '/'.join(str(entry.get(k) or '') for k in ('artist_name', 'concert_name', 'year'))
+        show = parse_show_info(str(entry))
+        if not show:
+            return jsonify(error=f'Each show needs an artist, concert and year (got "{entry}").'), 400
+        shows.append(show)
+    if not shows:
+        return jsonify(error='No shows given.'), 400
+
+    with instrumented("batch", shows=len(shows)) as metrics:
+        result = build_prep_playlists(access_token, shows)
+        response = make_response(jsonify(result), 502 if result.get("error") else 200)
+        if SERVER_TIMING:
+            response.headers['Server-Timing'] = metrics.server_timing()
+    return response
 
 # Route to actually process and create the playlist
 @app.route('/process')
 @app.route('/api/process')
 def process_playlist():
-    authorization_code = request.args.get('code')
-    if not authorization_code:
+    authorization_code = authorization_code_arg()
+    if not authorization_code and not session.get('token_key'):
         return render_template('result.html', error='Authorization code missing. Please try again.')
 
-    access_token = get_token(authorization_code)
+    access_token = request_access_token(authorization_code)
+    if not access_token and not authorization_code:
+        return render_template('result.html', error='Your Spotify login has expired. Please start over.')
     if not access_token:
         return render_template('result.html', error='Error retrieving access token. Please check your CLIENT_SECRET in the .env file.')
 
-    user_prof = user_profile(access_token)
-    if not user_prof:
-        return render_template('result.html', error='Error retrieving user profile.')
-
-    liked_songs = user_liked_songs(access_token)
-    if not liked_songs:
-        return render_template('result.html', error='Error retrieving user\'s liked songs.')
-    
-    top_user_tracks = user_top_tracks(access_token)
-    if not top_user_tracks:
-        return render_template('result.html', error='Error retrieving user\'s top tracks.')
-    
     # Retrieve artist/concert info from session
     artist_name = session.get('artist_name')
     concert_name = session.get('concert_name') or ''
@@ -490,73 +2797,88 @@ def process_playlist():
     
     if not artist_name:
         return render_template('result.html', error='Session expired. Please start over and enter an artist name.')
-    
-    artist_id = get_artist_id(access_token, artist_name)
-    if not artist_id or not artist_id[0]:
-        return render_template('result.html', error=f'Error retrieving artist\'s ID. Could not find "{artist_name}".')
-    artist_id_value = artist_id[0]
-    actual_artist_name = artist_id[1]  # Use the actual Spotify artist name
-    
-    top_artist_tracks = artist_top_tracks(access_token, artist_id_value, actual_artist_name)
-    if not top_artist_tracks:
-        return render_template('result.html', error='Error retrieving artist\'s top tracks.')
-   
-    setlist_result = find_setlist(access_token, actual_artist_name, concert_name or None, year or None)
-    setlist_tracks = None
-    actual_tour_title = None
-    setlist_url = None
-    if setlist_result[0] is not None:
-        setlist_tracks, actual_tour_title, setlist_url = setlist_result
 
-    playlist_result = ""
-    playlist_url = None
-
-    if setlist_tracks is not None:
-        playlist_result = unheard_tracks(user_prof["id"], access_token, liked_songs, top_user_tracks, top_artist_tracks, setlist_tracks, actual_artist_name, actual_tour_title=actual_tour_title)
-        print(playlist_result)
-    else:
-        # No setlist: use only looked-up artist name, no tour title (never user input)
-        playlist_result = unheard_tracks(user_prof["id"], access_token, liked_songs, top_user_tracks, top_artist_tracks, [], actual_artist_name)
-        print(playlist_result)
+    with instrumented("process") as metrics:
+        context = build_prep_playlist(access_token, artist_name, concert_name, year)
+        response = make_response(render_template('result.html', **context))
+        if SERVER_TIMING:
+            response.headers['Server-Timing'] = metrics.server_timing()
+    return response
+
+# Same as /process on the asyncio pipeline (needs httpx, and asgiref for async views)
+@app.route('/process-async')
+@app.route('/api/process-async')
+async def process_playlist_async():
+    authorization_code = authorization_code_arg()
+    if not authorization_code and not session.get('token_key'):
+        return render_template('result.html', error='Authorization code missing. Please try again.')
 
-    # Extract playlist URL from result if it contains one
-    if playlist_result:
-        # Try multiple patterns to extract the URL
-        url_patterns = [
-            r'https://open\.spotify\.com/playlist/[a-zA-Z0-9]+',
-            r'https://open\.spotify\.com/playlist/[^\s]+',
-        ]
-        for pattern in url_patterns:
-            url_match = re.search(pattern, playlist_result)
-            if url_match:
-                playlist_url = url_match.group(0)
-                break
-        
-        # Also try splitting by common phrases
-        if not playlist_url:
-            for phrase in ["Here's the link:", "link:", "Link:"]:
-                if phrase in playlist_result:
-                    try:
-                        potential_url = playlist_result.split(phrase)[1].strip().split()[0]
-                        if potential_url.startswith('http'):
-                            playlist_url = potential_url
-                            break
-                    except:
-                        pass
+    access_token = request_access_token(authorization_code)
+    if not access_token and not authorization_code:
+        return render_template('result.html', error='Your Spotify login has expired. Please start over.')
+    if not access_token:
+        return render_template('result.html', error='Error retrieving access token. Please check your CLIENT_SECRET in the .env file.')
 
-    # Only use looked-up values for display; never user input
-    display_artist_name = actual_artist_name
-    display_tour = actual_tour_title if actual_tour_title else "No setlist found"
+    artist_name = session.get('artist_name')
+    concert_name = session.get('concert_name') or ''
+    year = session.get('year') or ''
+    if not artist_name:
+        return render_template('result.html', error='Session expired. Please start over and enter an artist name.')
 
-    return render_template('result.html',
-        artist_name=display_artist_name,
-        tour_name=display_tour,
-        liked_songs_count=len(liked_songs),
-        user_top_tracks_count=len(top_user_tracks),
-        artist_top_tracks_count=len(top_artist_tracks),
-        setlist_found=setlist_tracks is not None,
-        setlist_tracks_count=len(setlist_tracks) if setlist_tracks else 0,
-        playlist_result=playlist_result,
-        playlist_url=playlist_url,
-        setlist_url=setlist_url
-    )
\ No newline at end of file
+    with instrumented("process_async") as metrics:
+        context = await build_prep_playlist_async(access_token, artist_name, concert_name, year)
+        response = make_response(render_template('result.html', **context))
+        if SERVER_TIMING:
+            response.headers['Server-Timing'] = metrics.server_timing()
+    return response
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="soundcheck from the command line")
+    commands = parser.add_subparsers(dest="command")
+    batch = commands.add_parser("batch", help="make prep playlists for every show in a file")
+    batch.add_argument("shows", help="file with one artist/concert/year per line ('-' for stdin)")
+    batch.add_argument("--token", default=os.getenv("SPOTIFY_ACCESS_TOKEN"),
+                       help="Spotify access token (default: $SPOTIFY_ACCESS_TOKEN)")
+    commands.add_parser("precompile-templates", help="fill TEMPLATE_CACHE_DIR with compiled templates (run before starting the server)")
+    args = parser.parse_args(argv)
+
+    if args.command == "precompile-templates":
+        if not TEMPLATE_CACHE_DIR:
+            parser.error("TEMPLATE_CACHE_DIR is empty, so there is no template cache to fill")
+        os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+        names = [name for name in app.jinja_env.list_templates() if name.endswith(".html")]
+        for name in names:
+            app.jinja_env.get_template(name)
+        print(f"Compiled {len(names)} templates into {os.path.abspath(TEMPLATE_CACHE_DIR)}")
+        return 0
+    if args.command != "batch":
+        parser.print_help()
+        return 1
+    if not args.token:
+        parser.error("a Spotify access token is required (--token or SPOTIFY_ACCESS_TOKEN)")
+
+    if args.shows == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(args.shows) as f:
+            lines = f.read().splitlines()
+    shows = []
+    for line in lines:
+        if line.strip() and not line.strip().startswith("#"):
+            show = parse_show_info(line)
+            if not show:
+                parser.error(f'each line needs an artist, concert and year: "{line}"')
+            shows.append(show)
+
+    result = build_prep_playlists(args.token, shows)
+    if result.get("error"):
+        print(result["error"])
+        return 1
+    for (artist, concert, year), show in zip(shows, result["shows"]):
+        print(f"{artist} / {concert} / {year}: {show.get('error') or show['playlist_result']}")
+    print(result["summary"])
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
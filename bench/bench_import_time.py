@@ -0,0 +1,105 @@
+"""
+Cold-start budget check for the serverless entry point.
+
+Starts a fresh interpreter per run (like a Vercel cold start), imports api/index.py under
+python -X importtime and serves the form (/api) and the loading page (/api/redirect). Reports the
+median import time, time to first response and the slowest imports, and fails if
+
+  - importing index takes longer than --budget-ms (median of --runs), or
+  - a module that should only load on the /process path (requests, httpx, asyncio, ...) was imported.
+
+    python bench/bench_import_time.py [--runs 5] [--budget-ms 400]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+API_DIR = os.path.join(HERE, "..", "api")
+
+# must stay out of a cold start that only serves the form / loading page
+LAZY_MODULES = ["requests", "urllib3", "httpx", "asyncio", "sqlite3", "argparse", "cProfile", "dotenv"]
+
+CHILD = f"""
+import sys, time
+sys.path.insert(0, {API_DIR!r})
+started = time.perf_counter()
+import index
+imported = time.perf_counter()
+client = index.app.test_client()
+assert client.get("/api").status_code == 200
+assert client.get("/api/redirect?code=bench").status_code == 200
+served = time.perf_counter()
+print("import_ms", (imported - started) * 1000)
+print("first_response_ms", (served - imported) * 1000)
+print("loaded", ",".join(m for m in {LAZY_MODULES!r} if m in sys.modules))
+"""
+
+
+def parse_importtime(stderr):
+    """[(cumulative us, module)] for the modules index.py imports itself (children are printed before their parent)."""
+    children = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|", 2)
+        if not cumulative.strip().isdigit():
+            continue
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth == 0:
+            if name.strip() == "index":
+                return children
+            children = []
+        elif depth == 1:
+            children.append((int(cumulative), name.strip()))
+    return []
+
+
+def run_once():
+    env = dict(os.environ, VERCEL="1")  # like production: no .env loading
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", CHILD], capture_output=True, text=True, env=env)
+    if result.returncode != 0:
+        raise SystemExit(result.stderr[-2000:])
+    values = dict(line.split(" ", 1) for line in result.stdout.splitlines() if " " in line)
+    return {
+        "import_ms": float(values["import_ms"]),
+        "first_response_ms": float(values["first_response_ms"]),
+        "loaded": [m for m in values.get("loaded", "").strip().split(",") if m],
+        "imports": parse_importtime(result.stderr),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="cold-start import budget for api/index.py")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=400.0, help="max median time to import index")
+    parser.add_argument("--top", type=int, default=8, help="how many of the slowest imports to list")
+    args = parser.parse_args()
+
+    runs = [run_once() for _ in range(args.runs)]
+    import_ms = statistics.median(r["import_ms"] for r in runs)
+    first_ms = statistics.median(r["first_response_ms"] for r in runs)
+
+    print(f"import index:        {import_ms:8.1f} ms (median of {args.runs}, budget {args.budget_ms:.0f} ms)")
+    print(f"form + loading page: {first_ms:8.1f} ms")
+    print("slowest imports (last run):")
+    for cumulative, name in sorted(runs[-1]["imports"], reverse=True)[:args.top]:
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+
+    failed = False
+    if import_ms > args.budget_ms:
+        print(f"FAIL: importing index took {import_ms:.1f} ms, over the {args.budget_ms:.0f} ms budget")
+        failed = True
+    loaded = sorted({m for r in runs for m in r["loaded"]})
+    if loaded:
+        print(f"FAIL: imported on a cold start but only needed later: {', '.join(loaded)}")
+        failed = True
+    if not failed:
+        print("OK")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,79 @@
+"""
+Micro-benchmark: known-song matching in unheard_tracks.
+
+Compares the old approach (list concat + linear track_in_list scans over raw
+Spotify JSON) with the KnownSongIndex built once per request. Tracks are
+projected to Track records while pages are parsed, so that step is not timed.
+
+    python bench/bench_known_songs.py [--sizes 1000 10000 50000] [--candidates 100]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "api"))
+
+from index import KnownSongIndex, parse_tracks  # noqa: E402
+
+
+def fake_track(i, artist_pool):
+    artists = random.sample(artist_pool, k=random.choice((1, 1, 1, 2)))
+    return {
+        "name": f"Song {i}",
+        "uri": f"spotify:track:{i:022d}",
+        "artists": [{"name": a, "id": a.lower().replace(' ', '')} for a in artists],
+        "external_ids": {"isrc": f"US{i:010d}"},
+    }
+
+
+def legacy_track_in_list(track, track_list):
+    artists = {a['name'].lower().strip() for a in track.get('artists', []) if a and a.get('name')}
+    return any(t['name'].lower().strip() == track['name'].lower().strip() and
+               {a['name'].lower().strip() for a in t.get('artists', []) if a and a.get('name')} == artists
+               for t in track_list)
+
+
+def legacy(liked_songs, top_user_tracks, candidates):
+    known_songs = liked_songs + [track for track in top_user_tracks if track not in liked_songs]
+    return [c['uri'] for c in candidates if not legacy_track_in_list(c, known_songs)]
+
+
+def indexed(liked_songs, top_user_tracks, candidates):
+    known_songs = KnownSongIndex(liked_songs)
+    known_songs.update(top_user_tracks)
+    return [c.uri for c in candidates if c not in known_songs]
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--candidates", type=int, default=100)
+    args = parser.parse_args()
+
+    random.seed(0)
+    artist_pool = [f"Artist {i}" for i in range(500)]
+
+    print(f"{'liked':>8} {'legacy (s)':>12} {'indexed (s)':>12} {'speedup':>9}")
+    for size in args.sizes:
+        liked_songs = [fake_track(i, artist_pool) for i in range(size)]
+        top_user_tracks = random.sample(liked_songs, k=min(50, size))
+        # half the candidates are known, half are new
+        candidates = random.sample(liked_songs, k=args.candidates // 2)
+        candidates += [fake_track(size + i, artist_pool) for i in range(args.candidates - len(candidates))]
+
+        legacy_time, legacy_result = timed(legacy, liked_songs, top_user_tracks, candidates)
+        indexed_time, indexed_result = timed(indexed, parse_tracks(liked_songs), parse_tracks(top_user_tracks), parse_tracks(candidates))
+        assert legacy_result == indexed_result
+        print(f"{size:>8} {legacy_time:>12.4f} {indexed_time:>12.4f} {legacy_time / indexed_time:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
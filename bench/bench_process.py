@@ -0,0 +1,178 @@
+"""
+End-to-end benchmark: the whole /process flow against bench/fake_spotify.py, no network needed.
+
+Starts the fake Spotify in a subprocess, points the app at it and runs /process through the Flask
+test client for synthetic users of each library size. Reports latency percentiles, Spotify requests
+per run (and which endpoints they went to), the slowest stages, and the peak Python memory of one
+extra traced run.
+
+By default every run is cold: shared cache, liked songs snapshot and created playlists are cleared
+first. --warm keeps them, which is what a returning user sees.
+
+    python bench/bench_process.py [--sizes 100 1000 10000 50000] [--runs 5] [--latency-ms 0] [--rate-limit 0] [--warm] [--async]
+"""
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def start_fake_spotify(args):
+    command = [sys.executable, os.path.join(HERE, "fake_spotify.py"), "--port", "0",
+               "--latency-ms", str(args.latency_ms), "--rate-limit", str(args.rate_limit)]
+    if args.page_size:
+        command += ["--page-size", str(args.page_size)]
+    fake = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = fake.stdout.readline()
+    env = dict(part.split("=", 1) for part in line.split())
+    return fake, env
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class EventCollector(logging.Handler):
+    """Keeps the JSON lines the app logs for each /process run (stage timings per run)."""
+
+    def __init__(self):
+        super().__init__()
+        self.events = []
+
+    def emit(self, record):
+        try:
+            self.events.append(json.loads(record.getMessage()))
+        except ValueError:
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000, 50000], help="liked songs per synthetic user")
+    parser.add_argument("--runs", type=int, default=5, help="timed runs per size")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="fake Spotify latency per request")
+    parser.add_argument("--page-size", type=int, default=None, help="max items per page from the fake")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="fraction of fake Spotify requests answered with 429")
+    parser.add_argument("--warm", action="store_true", help="keep caches, snapshots and playlists between runs")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="benchmark /process-async (needs httpx + asgiref)")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    fake, env = start_fake_spotify(args)
+    snapshot_dir = tempfile.mkdtemp(prefix="soundcheck-bench-")
+    os.environ.update(env)
+    os.environ.update({"SNAPSHOT_DIR": snapshot_dir, "VERCEL": "1", "CLIENT_ID": "bench", "CLIENT_SECRET": "bench",
+                       "REDIRECT_URI": "http://localhost/redirect"})
+    # no real Spotify calls from here on: only import once the fake is in place
+    sys.path.insert(0, os.path.join(HERE, "..", "api"))
+    import index  # noqa: E402
+
+    collector = EventCollector()
+    index.logger.handlers = [collector]
+    fake_url = env["SPOTIFY_ACCOUNTS_BASE"]
+
+    def fake_stats():
+        return requests.get(f"{fake_url}/_bench/stats").json()
+
+    def counted(fn):
+        """Runs fn; returns its wall time in ms, the Spotify requests it made per endpoint and how many got a 429."""
+        before = fake_stats()
+        started = time.perf_counter()
+        fn()
+        elapsed = (time.perf_counter() - started) * 1000
+        after = fake_stats()
+        endpoints = {k: v - before["calls"].get(k, 0) for k, v in after["calls"].items() if v - before["calls"].get(k, 0)}
+        return elapsed, endpoints, after["rate_limited"] - before["rate_limited"]
+
+    def reset(size, everything):
+        if everything:
+            requests.post(f"{fake_url}/_bench/reset", json={"liked": size})
+            index.shared_cache.backend = index.MemoryCache()
+            shutil.rmtree(snapshot_dir, ignore_errors=True)
+
+    def process():
+        client = index.app.test_client()
+        with client.session_transaction() as s:
+            s["artist_name"] = "Bench Artist"
+            s["concert_name"] = "Bench Tour"
+            s["year"] = "2024"
+        with contextlib.redirect_stdout(io.StringIO()):
+            response = client.get(f"{route}?code=bench")
+        html = response.get_data(as_text=True)
+        if response.status_code != 200 or '<div class="error-banner">' in html:
+            error = html.split('<div class="error-banner">')[-1].split("</div>")[0]
+            raise SystemExit(f"/process failed: {response.status_code} {' '.join(error.split())}")
+
+    route = "/api/process-async" if args.use_async else "/api/process"
+    results = []
+    try:
+        for size in args.sizes:
+            reset(size, everything=True)
+            latencies, calls, stages = [], [], {}
+            rate_limited = 0
+            for run in range(args.runs):
+                reset(size, everything=not args.warm)
+                collector.events.clear()
+                elapsed, endpoints, limited = counted(process)
+                latencies.append(elapsed)
+                calls.append(sum(endpoints.values()))
+                rate_limited += limited
+                for event in collector.events:
+                    for name, timing in event.get("stages", {}).items():
+                        stages.setdefault(name, []).append(timing["duration_ms"])
+
+            # one more run with tracemalloc on, kept out of the timings since tracing slows everything down
+            reset(size, everything=not args.warm)
+            tracemalloc.start()
+            process()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            results.append({
+                "liked_songs": size,
+                "runs": args.runs,
+                "p50_ms": round(percentile(latencies, 50), 1),
+                "p90_ms": round(percentile(latencies, 90), 1),
+                "p99_ms": round(percentile(latencies, 99), 1),
+                "max_ms": round(max(latencies), 1),
+                "requests_per_run": round(statistics.mean(calls), 1),
+                "rate_limited": rate_limited,
+                "peak_mb": round(peak / 1024 / 1024, 1),
+                "last_run_endpoints": dict(sorted(endpoints.items(), key=lambda e: -e[1])),
+                "stage_p50_ms": {name: round(percentile(durations, 50), 1) for name, durations in stages.items()},
+            })
+    finally:
+        fake.terminate()
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    mode = "warm" if args.warm else "cold"
+    print(f"{route}, {mode}, fake latency {args.latency_ms}ms, 429 rate {args.rate_limit}")
+    print(f"{'liked':>8} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9} {'requests':>9} {'429s':>6} {'peak MB':>8}  slowest stages (p50 ms)")
+    for r in results:
+        slowest = sorted(r["stage_p50_ms"].items(), key=lambda s: -s[1])[:3]
+        print(f"{r['liked_songs']:>8} {r['p50_ms']:>9} {r['p90_ms']:>9} {r['p99_ms']:>9} {r['max_ms']:>9} "
+              f"{r['requests_per_run']:>9} {r['rate_limited']:>6} {r['peak_mb']:>8}  "
+              + ", ".join(f"{name}={ms}" for name, ms in slowest))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Memory benchmark: raw Spotify track JSON vs Track records for a liked-songs library.
+
+Pages are decoded from JSON strings shaped like real /v1/me/tracks responses
+(album art, available_markets, ...), and the memory still held once the whole
+library is loaded is measured with tracemalloc.
+
+    python bench/bench_track_memory.py [--sizes 1000 15000]
+"""
+import argparse
+import json
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "api"))
+
+from index import Track  # noqa: E402
+
+MARKETS = ["AD", "AE", "AR", "AT", "AU", "BE", "BG", "BO", "BR", "CA", "CH", "CL", "CO", "CR", "CY", "CZ",
+           "DE", "DK", "DO", "EC", "EE", "ES", "FI", "FR", "GB", "GR", "GT", "HK", "HN", "HU", "ID", "IE",
+           "IL", "IN", "IS", "IT", "JP", "LI", "LT", "LU", "LV", "MC", "MT", "MX", "MY", "NI", "NL", "NO",
+           "NZ", "PA", "PE", "PH", "PL", "PT", "PY", "RO", "SE", "SG", "SK", "SV", "TH", "TR", "TW", "US",
+           "UY", "VN", "ZA"]
+
+
+def fake_page(offset, limit):
+    items = []
+    for i in range(offset, offset + limit):
+        artist = {"id": f"artist{i % 300:018d}", "name": f"Artist {i % 300}", "type": "artist",
+                  "uri": f"spotify:artist:artist{i % 300:018d}",
+                  "href": f"https://api.spotify.com/v1/artists/artist{i % 300:018d}",
+                  "external_urls": {"spotify": f"https://open.spotify.com/artist/artist{i % 300:018d}"}}
+        album = {"id": f"album{i:017d}", "name": f"Album {i}", "album_type": "album", "release_date": "2020-01-01",
+                 "total_tracks": 12, "artists": [artist], "available_markets": MARKETS,
+                 "images": [{"url": f"https://i.scdn.co/image/{size}{i:030d}", "height": size, "width": size}
+                            for size in (640, 300, 64)],
+                 "external_urls": {"spotify": f"https://open.spotify.com/album/album{i:017d}"}}
+        track = {"id": f"{i:022d}", "name": f"Song {i}", "uri": f"spotify:track:{i:022d}", "artists": [artist],
+                 "album": album, "available_markets": MARKETS, "duration_ms": 200000 + i, "explicit": False,
+                 "external_ids": {"isrc": f"US{i:010d}"}, "popularity": i % 100, "track_number": 1,
+                 "disc_number": 1, "preview_url": None, "is_local": False,
+                 "external_urls": {"spotify": f"https://open.spotify.com/track/{i:022d}"}}
+        items.append({"added_at": "2024-01-01T00:00:00Z", "track": track})
+    return json.dumps({"items": items, "total": offset + limit})
+
+
+def held_memory(size, project):
+    tracemalloc.start()
+    library = []
+    for offset in range(0, size, 50):
+        page = json.loads(fake_page(offset, 50))
+        for item in page["items"]:
+            library.append(Track.from_spotify(item["track"]) if project else item["track"])
+        del page
+    held, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return held, peak, len(library)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 15000])
+    args = parser.parse_args()
+
+    print(f"{'liked':>8} {'raw held (MB)':>14} {'Track held (MB)':>16} {'ratio':>7}")
+    for size in args.sizes:
+        raw_held, _, _ = held_memory(size, project=False)
+        slim_held, _, _ = held_memory(size, project=True)
+        print(f"{size:>8} {raw_held / 2**20:>14.2f} {slim_held / 2**20:>16.2f} {raw_held / slim_held:>6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+"""
+Local stand-in for the parts of the Spotify Web API soundcheck uses, for offline benchmarks.
+
+Serves a synthetic user with a configurable number of liked songs, one artist, a handful of
+setlist playlists and whatever playlists the app creates. Latency, the max page size and a
+rate of injected 429s are configurable. POST /_bench/reset {"liked": n} starts over with a new
+library and GET /_bench/stats returns the request counts. Point the app at it with
+
+    SPOTIFY_API_BASE=http://127.0.0.1:8888/v1 SPOTIFY_ACCOUNTS_BASE=http://127.0.0.1:8888
+
+    python bench/fake_spotify.py [--port 8888] [--liked 10000] [--latency-ms 20] [--rate-limit 0.01]
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+ARTIST_NAME = "Bench Artist"
+ARTIST_ID = "benchartist"
+TOUR_NAME = "Bench Tour"
+TOUR_YEAR = "2024"
+USER_ID = "benchuser"
+
+
+def fake_track(i, artist_name=None, artist_id=None):
+    artist_name = artist_name or f"Artist {i % 997}"
+    artist_id = artist_id or f"artist{i % 997}"
+    return {
+        "album": {
+            "album_type": "album",
+            "id": f"album{i // 12}",
+            "name": f"Album {i // 12}",
+            "images": [{"url": f"https://i.example/{i // 12}/{size}", "height": size, "width": size}
+                       for size in (640, 300, 64)],
+            "release_date": "2020-01-01",
+        },
+        "artists": [{"id": artist_id, "name": artist_name, "type": "artist", "uri": f"spotify:artist:{artist_id}"}],
+        "available_markets": ["CA", "US", "GB", "DE", "FR", "JP"],
+        "duration_ms": 180000 + i % 60000,
+        "explicit": False,
+        "external_ids": {"isrc": f"QZ{i:010d}"},
+        "external_urls": {"spotify": f"https://open.spotify.com/track/t{i}"},
+        "id": f"t{i}",
+        "name": f"Song {i}",
+        "popularity": i % 100,
+        "preview_url": None,
+        "track_number": i % 12 + 1,
+        "type": "track",
+        "uri": f"spotify:track:t{i}",
+    }
+
+
+class FakeSpotify:
+    """The data behind the server plus request counters. Safe to reconfigure between runs."""
+
+    def __init__(self, liked=1000, latency_ms=0.0, page_size=None, rate_limit=0.0, setlists=6, setlist_length=25, albums=20, seed=0):
+        self.latency_ms = latency_ms
+        self.albums = albums
+        self.page_size = page_size
+        self.rate_limit = rate_limit
+        self.setlists = setlists
+        self.setlist_length = setlist_length
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.reset(liked)
+
+    def reset(self, liked=None):
+        """New library size (if given), no created playlists, counters back to zero."""
+        with self.lock:
+            if liked is not None:
+                self.liked = liked
+            # the artist's catalogue is songs 0-39; the user has liked every third of them
+            self.artist_songs = list(range(40))
+            self.liked_ids = [i for i in range(self.liked + 40) if i >= 40 or i % 3 == 0][:self.liked]
+            self.liked_set = {f"t{i}" for i in self.liked_ids}
+            self.playlists = {}
+            self.calls = Counter()
+            self.rate_limited = 0
+
+    def track(self, i):
+        if i < 40:
+            return fake_track(i, ARTIST_NAME, ARTIST_ID)
+        return fake_track(i)
+
+    def url(self, base, path, **params):
+        query = "&".join(f"{k}={v}" for k, v in params.items())
+        return f"{base}{path}?{query}" if query else f"{base}{path}"
+
+    def limit(self, limit, max_limit=50):
+        # spotify's own cap for the endpoint, or a smaller one to test paging
+        return min(limit, max_limit, self.page_size or max_limit)
+
+    def page(self, base, path, items, offset, limit, total=None, max_limit=50):
+        """A paging object; pass total when items is already just this page."""
+        limit = self.limit(limit, max_limit)
+        end = offset + limit
+        if total is None:
+            total = len(items)
+            items = items[offset:end]
+        return {
+            "href": self.url(base, path, offset=offset, limit=limit),
+            "items": items[:limit],
+            "limit": limit,
+            "offset": offset,
+            "total": total,
+            "next": self.url(base, path, offset=end, limit=limit) if end < total else None,
+            "previous": None,
+        }
+
+    def handle(self, method, path, query, body, base):
+        """(status, payload) for one request."""
+        endpoint = re.sub(r'/(playlists|artists)/[^/]+', r'/\1/{id}', path)
+        with self.lock:
+            self.calls[f"{method} {endpoint}"] += 1
+            if self.rate_limit and path != "/api/token" and self.random.random() < self.rate_limit:
+                self.rate_limited += 1
+                return 429, {"error": {"status": 429, "message": "API rate limit exceeded"}}
+
+        offset = int(query.get("offset", 0))
+        limit = int(query.get("limit", 20))
+
+        if path == "/api/token":
+            return 200, {"access_token": "bench-token", "token_type": "Bearer", "expires_in": 3600,
+                         "refresh_token": "bench-refresh", "scope": ""}
+        if path == "/v1/me":
+            return 200, {"id": USER_ID, "display_name": "Bench User", "country": "CA"}
+        if path == "/v1/me/tracks" and method == "GET":
+            # newest first
+            count = len(self.liked_ids)
+            items = [{"added_at": f"2024-01-01T00:00:00.{count - n:06d}Z", "track": self.track(self.liked_ids[n])}
+                     for n in range(offset, min(offset + self.limit(limit), count))]
+            return 200, self.page(base, "/me/tracks", items, offset, limit, total=count)
+        if path == "/v1/me/tracks/contains":
+            return 200, [track_id in self.liked_set for track_id in query.get("ids", "").split(",")]
+        if path == "/v1/me/top/tracks":
+            # a different slice of the library per time range, so the ranges overlap but aren't the same
+            start = {"short_term": 0, "medium_term": 25, "long_term": 50}.get(query.get("time_range"), 25)
+            return 200, self.page(base, "/me/top/tracks", [self.track(i) for i in self.liked_ids[start:start + 50]], offset, limit)
+        if path == "/v1/me/player/recently-played":
+            # two of the artist's songs they never liked, then the rest of the library
+            played = [1, 2] + self.liked_ids[:48]
+            return 200, {"items": [{"played_at": "2024-01-01T00:00:00Z", "track": self.track(i)} for i in played[:limit]],
+                         "next": None, "limit": limit}
+        if path == "/v1/me/albums":
+            # the first saved album is the artist's: songs 20-31
+            albums = [{"added_at": "2024-01-01T00:00:00Z", "album": {
+                "id": f"album{n}", "name": f"Album {n}", "album_type": "album",
+                "tracks": {"items": [{k: v for k, v in self.track(20 + j if n == 0 else 10 ** 6 + n * 12 + j).items() if k not in ("album", "external_ids")}
+                                     for j in range(12)], "total": 12, "next": None}}} for n in range(self.albums)]
+            return 200, self.page(base, "/me/albums", albums, offset, limit)
+        if path == "/v1/search":
+            kind = query.get("type")
+            if kind == "artist":
+                return 200, {"artists": self.page(base, "/search", [{"id": ARTIST_ID, "name": ARTIST_NAME, "type": "artist"}], 0, limit)}
+            if kind == "track":
+                return 200, {"tracks": self.page(base, "/search", [], 0, limit)}
+            names = [f"{ARTIST_NAME} {TOUR_NAME} Setlist {TOUR_YEAR}"] + [
+                f"{ARTIST_NAME} setlist #{n}" for n in range(1, self.setlists)]
+            items = [{"id": f"setlist{n}", "name": name, "external_urls": {"spotify": f"https://open.spotify.com/playlist/setlist{n}"},
+                      "owner": {"id": "fan"}, "tracks": {"total": self.setlist_length}}
+                     for n, name in enumerate(names)] + [None]
+            return 200, {"playlists": self.page(base, "/search", items, 0, limit)}
+
+        match = re.fullmatch(r'/v1/artists/([^/]+)/top-tracks', path)
+        if match:
+            return 200, {"tracks": [self.track(i) for i in self.artist_songs[:10]]}
+
+        match = re.fullmatch(r'/v1/playlists/([^/]+)(/tracks)?', path)
+        if match:
+            return self.playlist(method, match.group(1), bool(match.group(2)), body, base, offset, limit)
+
+        if path == "/v1/me/playlists" and method == "POST":
+            with self.lock:
+                playlist_id = f"created{len(self.playlists)}"
+                self.playlists[playlist_id] = {"name": body.get("name"), "uris": [], "snapshots": 0}
+            return 201, {"id": playlist_id, "name": body.get("name"), "snapshot_id": "s0",
+                         "external_urls": {"spotify": f"https://open.spotify.com/playlist/{playlist_id}"}}
+        if path == "/v1/me/playlists":
+            items = [{"id": f"other{n}", "name": f"Other playlist {n}", "owner": {"id": USER_ID},
+                      "external_urls": {"spotify": ""}, "snapshot_id": "s"} for n in range(30)]
+            items += [{"id": playlist_id, "name": playlist["name"], "owner": {"id": USER_ID}, "snapshot_id": f"s{playlist['snapshots']}",
+                       "external_urls": {"spotify": f"https://open.spotify.com/playlist/{playlist_id}"}}
+                      for playlist_id, playlist in self.playlists.items()]
+            return 200, self.page(base, "/me/playlists", items, offset, limit)
+        return 404, {"error": {"status": 404, "message": f"No fake for {method} {path}"}}
+
+    def playlist(self, method, playlist_id, tracks, body, base, offset, limit):
+        created = self.playlists.get(playlist_id)
+        if not tracks:
+            if created:
+                return 200, {"id": playlist_id, "name": created["name"], "followers": {"total": 0},
+                             "snapshot_id": f"s{created['snapshots']}", "tracks": {"total": len(created["uris"])},
+                             "external_urls": {"spotify": f"https://open.spotify.com/playlist/{playlist_id}"}}
+            n = int(playlist_id[len("setlist"):] or 0) if playlist_id.startswith("setlist") else 0
+            return 200, {"id": playlist_id, "name": f"{ARTIST_NAME} {TOUR_NAME} Setlist {TOUR_YEAR}" if n == 0 else f"{ARTIST_NAME} setlist #{n}",
+                         "followers": {"total": 1000 - n * 10},
+                         "external_urls": {"spotify": f"https://open.spotify.com/playlist/{playlist_id}"}}
+
+        if method == "GET":
+            if created:
+                items = [{"track": {"uri": uri, "name": uri, "artists": []}} for uri in created["uris"]]
+            else:
+                # half the setlist is the artist's catalogue, half deep cuts nobody has liked
+                items = [{"track": self.track(i)} for i in self.artist_songs[:self.setlist_length // 2]]
+                items += [{"track": fake_track(10 ** 7 + i, ARTIST_NAME, ARTIST_ID)} for i in range(self.setlist_length - len(items))]
+            return 200, self.page(base, f"/playlists/{playlist_id}/tracks", items, offset, limit, max_limit=100)
+
+        if created is None:
+            return 403, {"error": {"status": 403, "message": "You can't edit this playlist"}}
+        with self.lock:
+            if method == "POST":
+                uris = body.get("uris", [])
+                position = body.get("position")
+                if position is None:
+                    created["uris"].extend(uris)
+                else:
+                    created["uris"][position:position] = uris
+            elif method == "DELETE":
+                removed = {t["uri"] for t in body.get("tracks", [])}
+                created["uris"] = [uri for uri in created["uris"] if uri not in removed]
+            created["snapshots"] += 1
+            return (201 if method == "POST" else 200), {"snapshot_id": f"s{created['snapshots']}"}
+
+
+class FakeSpotifyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real API
+    disable_nagle_algorithm = True  # otherwise small responses sit in delayed-ACK limbo for ~40ms
+
+    def respond(self):
+        spotify = self.server.spotify
+        if spotify.latency_ms:
+            time.sleep(spotify.latency_ms / 1000)
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        try:
+            body = json.loads(raw) if raw and self.headers.get("Content-Type", "").startswith("application/json") else {}
+        except ValueError:
+            body = {}
+        base = f"http://{self.headers.get('Host')}/v1"
+        if url.path == "/_bench/reset":
+            spotify.reset(body.get("liked"))
+            status, payload = 200, {"liked": spotify.liked}
+        elif url.path == "/_bench/stats":
+            status, payload = 200, {"calls": spotify.calls, "rate_limited": spotify.rate_limited}
+        else:
+            status, payload = spotify.handle(self.command, url.path, query, body, base)
+
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        if status == 429:
+            self.send_header("Retry-After", "0")
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PUT = do_DELETE = respond
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(spotify, host="127.0.0.1", port=0):
+    """Starts the fake in a background thread; returns (server, base_url). port=0 picks a free port."""
+    server = ThreadingHTTPServer((host, port), FakeSpotifyHandler)
+    server.daemon_threads = True
+    server.spotify = spotify
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="fake Spotify API for offline benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8888, help="0 picks a free port")
+    parser.add_argument("--liked", type=int, default=1000, help="number of liked songs")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="added to every response")
+    parser.add_argument("--page-size", type=int, default=None, help="max items per page (default: spotify's per-endpoint max)")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument("--albums", type=int, default=20, help="number of saved albums")
+    args = parser.parse_args()
+
+    spotify = FakeSpotify(args.liked, args.latency_ms, args.page_size, args.rate_limit, albums=args.albums)
+    server, base_url = serve(spotify, args.host, args.port)
+    print(f"SPOTIFY_API_BASE={base_url}/v1 SPOTIFY_ACCOUNTS_BASE={base_url}", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# like production: no .env loading, and nothing talks to the real Spotify
+os.environ.setdefault("VERCEL", "1")
+os.environ.setdefault("SPOTIFY_API_BASE", "http://127.0.0.1:9/v1")
+os.environ.setdefault("SPOTIFY_ACCOUNTS_BASE", "http://127.0.0.1:9")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "api"))
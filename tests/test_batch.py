@@ -0,0 +1,34 @@
+import index
+
+
+class FakeResponse:
+    def __init__(self, data, status_code=200):
+        self.data = data
+        self.status_code = status_code
+        self.text = ""
+
+    def json(self):
+        return self.data
+
+
+def fake_search(url, params=None, **kwargs):
+    # the artist search only knows one artist
+    artists = [{"id": "known", "name": "Known Artist"}] if params["q"] == "Known Artist" else []
+    return FakeResponse({"artists": {"items": artists}})
+
+
+def test_unknown_artist_only_fails_its_own_show(monkeypatch):
+    song = index.Track("spotify:track:1", "song", ["known"], ["known artist"])
+    monkeypatch.setattr(index, "spotify_get", fake_search)
+    monkeypatch.setattr(index, "resolve_user", lambda access_token, timer, progress=None: ({"id": "user"}, [song], False))
+    monkeypatch.setattr(index, "user_known_tracks", lambda access_token: [song])
+    monkeypatch.setattr(index, "artist_top_tracks", lambda access_token, artist_id, artist_name: [song])
+    monkeypatch.setattr(index, "find_setlist", lambda access_token, artist_name, concert_name=None, year=None: (None, None, None))
+    monkeypatch.setattr(index, "unheard_tracks", lambda *args, **kwargs: "No new songs to add!")
+
+    result = index.build_prep_playlists("token", [("Known Artist", "Tour", "2024"), ("Nobody At All", "Tour", "2024")])
+
+    known, unknown = result["shows"]
+    assert known["artist_name"] == "Known Artist"
+    assert "error" not in known
+    assert unknown == {"error": 'Error retrieving artist\'s ID. Could not find "Nobody At All".'}
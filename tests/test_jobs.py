@@ -0,0 +1,36 @@
+import os
+import sys
+
+import index
+
+
+def make_queue(store, max_finished=3):
+    return index.JobQueue(store, workers=1, max_finished=max_finished)
+
+
+def test_running_job_survives_many_finished_jobs(tmp_path):
+    for store in (index.MemoryCache(max_entries=sys.maxsize),
+                  index.SQLiteCache(os.path.join(tmp_path, "jobs.sqlite3"), max_entries=sys.maxsize)):
+        queue = make_queue(store)
+        queue.update("running", status="running")
+        failed = [queue.fail("nope") for _ in range(10)]
+
+        queue.progress("running", "liked_songs", fetched=50)
+        assert queue.get("running")["stages"] == {"liked_songs": {"fetched": 50}}
+        # only the newest finished jobs are kept
+        assert [job_id for job_id in failed if queue.get(job_id)] == failed[-3:]
+
+
+def test_progress_for_a_missing_job_is_ignored():
+    queue = make_queue(index.MemoryCache())
+    queue.progress("gone", "liked_songs", fetched=50)
+    assert queue.get("gone") is None
+
+
+def test_job_status_of_a_partial_job(monkeypatch):
+    queue = make_queue(index.MemoryCache())
+    queue.store.set("partial", {"status": "done"}, 0)
+    monkeypatch.setattr(index, "job_queue", queue)
+    response = index.app.test_client().get("/api/jobs/partial")
+    assert response.status_code == 200
+    assert response.get_json() == {"id": "partial", "status": "done", "stages": {}, "error": None}
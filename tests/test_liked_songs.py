@@ -0,0 +1,23 @@
+import threading
+
+import index
+
+
+def test_stream_requests_every_page_once(monkeypatch):
+    page_size = 50
+    total = (index.LIKED_SONGS_WORKERS + 1) * page_size * 2 + 10
+    requested = []
+    lock = threading.Lock()
+
+    def fake_page(access_token, offset, limit=50):
+        with lock:
+            requested.append(offset)
+        end = min(offset + limit, total)
+        return {"items": list(range(offset, end)), "total": total, "next": "more" if end < total else None}
+
+    monkeypatch.setattr(index, "liked_songs_page", fake_page)
+    pages = list(index.iter_liked_song_pages("token", page_size))
+
+    expected = list(range(0, total, page_size))
+    assert sorted(requested) == expected
+    assert [page["items"][0] for page in pages] == expected  # newest first, nothing skipped
@@ -0,0 +1,73 @@
+import pytest
+
+import index
+
+
+def track(uri, name, *artists, isrc=None):
+    return index.Track.from_spotify({
+        "uri": uri,
+        "name": name,
+        "artists": [{"id": artist.lower(), "name": artist} for artist in artists],
+        "external_ids": {"isrc": isrc} if isrc else {},
+    })
+
+
+def is_known(known, candidate):
+    """Whether candidate counts as known, checked both ways the pipeline matches (they must agree)."""
+    in_index = candidate in index.KnownSongIndex(known)
+    matcher = index.CandidateMatcher([candidate])
+    for song in known:
+        matcher.strike(song)
+    assert in_index == matcher.done()
+    return in_index
+
+
+@pytest.mark.parametrize("name, title", [
+    ("Song - Remastered 2011", "song"),
+    ("Song - 2011 Remaster", "song"),
+    ("Song (Live)", "song"),
+    ("Song [Live at Wembley]", "song"),
+    ("Song (feat. Someone)", "song"),
+    ("Song Feat. Someone", "song"),
+    ("Song ft. Someone", "song"),
+    ("Live Forever", "live forever"),
+    ("Live Forever - Remastered", "live forever"),
+    ("Don't Stop Me Now", "don t stop me now"),
+])
+def test_normalize_title(name, title):
+    assert index.normalize_title(name) == title
+    assert index.normalize_title(name.lower()) == title
+
+
+@pytest.mark.parametrize("known_name, candidate_name", [
+    ("Song", "Song - Remastered 2011"),
+    ("Song - Remastered 2011", "Song"),
+    ("Song", "Song (Live)"),
+    ("Song (Live at Wembley)", "Song - Live"),
+])
+def test_versions_of_a_known_song_are_known(known_name, candidate_name):
+    assert is_known([track("spotify:track:a", known_name, "Artist")], track("spotify:track:b", candidate_name, "Artist"))
+
+
+def test_live_is_only_stripped_as_a_suffix():
+    known = [track("spotify:track:a", "Forever", "Artist")]
+    assert not is_known(known, track("spotify:track:b", "Live Forever", "Artist"))
+
+
+def test_featured_artists_dont_matter():
+    known = [track("spotify:track:a", "Song (feat. Guest)", "Artist", "Guest")]
+    assert is_known(known, track("spotify:track:b", "Song", "Artist"))
+    assert is_known(known, track("spotify:track:c", "Song (feat. Someone Else)", "Artist", "Someone Else"))
+
+
+def test_same_title_by_another_artist_is_not_known():
+    # (artist, title) is the key: a featured artist's song doesn't make another artist's song with the same title known
+    known = [track("spotify:track:a", "Intro (feat. Guest)", "Artist", "Guest")]
+    assert not is_known(known, track("spotify:track:b", "Intro", "Other"))
+    assert not is_known(known, track("spotify:track:c", "Intro (feat. Guest)", "Other", "Guest"))
+
+
+def test_uri_and_isrc_match_whatever_the_name():
+    known = [track("spotify:track:a", "Song", "Artist", isrc="USABC0000001")]
+    assert is_known(known, track("spotify:track:a", "Renamed", "Artist"))
+    assert is_known(known, track("spotify:track:b", "Song (2020 Mix)", "Someone", isrc="USABC0000001"))
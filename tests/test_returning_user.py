@@ -0,0 +1,117 @@
+import re
+import threading
+import time
+
+import pytest
+
+import index
+
+
+@pytest.fixture
+def client(monkeypatch):
+    exchanged = []
+
+    def failing_exchange(code):
+        # real Spotify rejects anything that isn't a fresh authorization code
+        exchanged.append(code)
+        return None
+
+    built = []
+
+    def fake_build(access_token, artist_name, concert_name=None, year=None, progress=None):
+        built.append(access_token)
+        return {"artist_name": artist_name, "tour_name": concert_name, "playlist_result": "ok"}
+
+    monkeypatch.setattr(index, "exchange_token", failing_exchange)
+    monkeypatch.setattr(index, "build_prep_playlist", fake_build)
+    client = index.app.test_client()
+    client.exchanged = exchanged
+    client.built = built
+
+    # a returning user: their token is already in the store
+    index.token_store.set("returning", {"access_token": "stored-token", "expires_at": time.time() + 3600}, time.time())
+    with client.session_transaction() as s:
+        s["token_key"] = "returning"
+    yield client
+    index.token_store.delete("returning")
+
+
+def submit_show(client):
+    response = client.post("/api", data={"artist_name": "Artist", "concert_name": "Tour", "year": "2024"})
+    assert response.status_code == 302
+    assert response.headers["Location"].endswith("/api/redirect")  # no OAuth round-trip
+    return client.get(response.headers["Location"])
+
+
+def wait_for(client, job_id):
+    for _ in range(100):
+        job = client.get(f"/api/jobs/{job_id}").get_json()
+        if job["status"] in ("done", "error"):
+            return job
+        time.sleep(0.01)
+    raise AssertionError("job never finished")
+
+
+def test_loading_page_has_no_placeholder_code(client):
+    html = submit_show(client).get_data(as_text=True)
+    assert "code=None" not in html
+    assert "'/api/process'" in html
+
+
+def test_job_uses_stored_token(client, monkeypatch):
+    monkeypatch.setattr(index, "USE_JOBS", True)
+    html = submit_show(client).get_data(as_text=True)
+    # start the job the way the loading page does
+    jobs_url = re.search(r"fetch\('(/api/jobs[^'/]*)', \{ method: 'POST'", html).group(1)
+    response = client.post(jobs_url)
+    assert response.status_code == 202
+    job = wait_for(client, response.get_json()["job_id"])
+    assert job["status"] == "done"
+    assert client.built == ["stored-token"]
+    assert client.exchanged == []
+
+
+@pytest.mark.parametrize("code", ["None", ""])
+def test_placeholder_code_falls_back_to_stored_token(client, code):
+    submit_show(client)
+    response = client.post(f"/api/jobs?code={code}")
+    job = wait_for(client, response.get_json()["job_id"])
+    assert job["status"] == "done"
+    assert client.exchanged == []
+
+    assert client.get(f"/api/process?code={code}").status_code == 200
+    assert client.built == ["stored-token", "stored-token"]
+    assert client.exchanged == []
+
+
+def test_slow_refresh_only_holds_up_its_own_user(monkeypatch):
+    started, release = threading.Event(), threading.Event()
+
+    def slow_refresh(token):
+        started.set()
+        release.wait(5)
+        return {"access_token": "refreshed", "refresh_token": "r", "expires_at": time.time() + 3600}
+
+    monkeypatch.setattr(index, "refresh_token", slow_refresh)
+    expired = "expired-user"
+    fresh = next(f"fresh-{i}" for i in range(1000) if index.token_lock(f"fresh-{i}") is not index.token_lock(expired))
+    index.token_store.set(expired, {"access_token": "old", "refresh_token": "r", "expires_at": 0}, time.time())
+    index.token_store.set(fresh, {"access_token": "fresh-token", "expires_at": time.time() + 3600}, time.time())
+
+    def stored(token_key):
+        with index.app.test_request_context():
+            index.session["token_key"] = token_key
+            return index.stored_access_token()
+
+    refreshing = threading.Thread(target=stored, args=(expired,))
+    refreshing.start()
+    try:
+        assert started.wait(5)
+        began = time.monotonic()
+        assert stored(fresh) == "fresh-token"
+        assert time.monotonic() - began < 1
+    finally:
+        release.set()
+        refreshing.join()
+        index.token_store.delete(expired)
+        index.token_store.delete(fresh)